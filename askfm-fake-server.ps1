@@ -0,0 +1 @@
+py tools/fake_server.py $args
\ No newline at end of file
@@ -0,0 +1 @@
+py media_queue.py $args
\ No newline at end of file
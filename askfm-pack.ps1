@@ -0,0 +1 @@
+py media_pack.py $args
\ No newline at end of file
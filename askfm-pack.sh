@@ -0,0 +1,3 @@
+#!/bin/bash
+
+python3 media_pack.py $@
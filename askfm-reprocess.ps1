@@ -0,0 +1 @@
+py reprocess.py $args
\ No newline at end of file
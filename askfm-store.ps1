@@ -0,0 +1 @@
+py media_store.py $args
\ No newline at end of file
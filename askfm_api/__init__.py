@@ -2,19 +2,33 @@ from __future__ import annotations
 
 import contextlib
 import hmac
-import itertools
 import json
 import logging
+import queue
 import secrets
+import threading
 import time
+from collections import Counter
 from dataclasses import dataclass, field
-from typing import Any, Iterator, Optional, Union
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Iterator, Optional, Union
 from urllib.parse import quote
 
-from requests import Session
+from requests import RequestException
 
 from . import requests as _r
-from .errors import AskfmApiError, OperationError, RequestError, SessionError
+from .errors import (
+    AskfmApiError,
+    OperationError,
+    RequestError,
+    SessionError,
+    TransportError,
+)
+from .pool import AskfmApiPool
+from .ratelimit import RateLimiter, SqliteBucketStore
+from .retry import Retrier, RetryBudget, RetryPolicy
+from .session_cache import SessionCache, SessionState
+from .transport import Transport, TransportSession
 
 # === Defaults ===
 DEFAULT_HEADERS = {
@@ -26,6 +40,7 @@ DEFAULT_HEADERS = {
 }
 DEFAULT_HOST = "api.ask.fm:443"
 DEFAULT_LIMIT = 50
+SESSION_SAVE_INTERVAL = 10  # seconds between writes of the rolling rt to the cache
 
 # === Types ===
 ReqParams = dict[str, Any]
@@ -33,6 +48,19 @@ StrParams = dict[str, str]
 Response = Any
 Auth = tuple[str, str]  # login, password
 
+logger = logging.getLogger(__name__)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a `Retry-After` header given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    with contextlib.suppress(ValueError):
+        return max(0.0, float(value))
+    with contextlib.suppress(TypeError, ValueError):
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    return None
+
 
 @dataclass
 class Request:
@@ -45,16 +73,17 @@ class Request:
     item_id_key: Optional[str] = None
 
 
-class AskfmApi:
+class _ApiBase:
+    """Request building and signing shared by the sync and async clients."""
+
     api_key: bytes
     auto_refresh_session: bool
     device_id: str
     auth: Optional[Auth]
-    headers: dict[str, str]
 
     logged_in: bool = False
-    sess: Session
     rt: str = "1"
+    scheme: str = "https"
 
     _access_token: Optional[str] = None
     _host: str
@@ -63,6 +92,57 @@ class AskfmApi:
     def random_device_id(cls):
         return secrets.token_hex(8)
 
+    def _request_params(
+        self, req: Request, offset: int, from_ts: Optional[int], limit: int
+    ) -> ReqParams:
+        if not req.paginated:
+            return req.params
+        if from_ts is None:
+            return {"offset": offset, "limit": limit, **req.params}
+        params = {"limit": limit, **req.params}
+        # req.params could have `from` and end up overriding the iterator value
+        params["from"] = from_ts
+        return params
+
+    def _sign_request(
+        self, method: str, path: str, params: Optional[ReqParams]
+    ) -> tuple[str, ReqParams, bool, dict[str, str]]:
+        """Return the url, the signed params, whether they go in the body, and the headers."""
+        params = params or {}
+        method = method.upper()
+        has_body = method in ["POST", "PUT"]
+        url = f"{self.scheme}://{self.host}{path}"
+
+        params = {"rt": self.rt, "ts": int(time.time()), **params}
+        params = self.normalize_params(params)
+        if has_body:
+            params = {"json": json.dumps(params, sort_keys=True, separators=(",", ":"))}
+        signature = f"HMAC {self.get_signature(method, path, params)}"
+        return url, params, has_body, {"Authorization": signature}
+
+    def normalize_params(self, params: ReqParams) -> ReqParams:
+        result = {}
+        for k, v in params.items():
+            if v is None:
+                continue
+            if isinstance(v, (int, bool)):
+                v = str(v).lower()
+            result[k] = v
+        return result
+
+    def get_signature(self, method: str, path: str, params: StrParams) -> str:
+        quoted = [key + "%" + quote(val, safe="!'()~") for (key, val) in params.items()]
+        msg = "%".join(sorted(quoted))
+        msg = "%".join([method.upper(), self.host, path, msg])
+
+        hmac_ = hmac.new(self.api_key, msg.encode(), "sha1")
+        return hmac_.hexdigest()
+
+
+class AskfmApi(_ApiBase):
+    headers: dict[str, str]
+    sess: TransportSession
+
     def __init__(
         self,
         api_key: Union[str, bytes],
@@ -73,18 +153,44 @@ class AskfmApi:
         logged_in: bool = False,
         auth: Optional[Auth] = None,
         host: str = DEFAULT_HOST,
+        scheme: str = "https",
         headers: dict[str, str] = DEFAULT_HEADERS,
+        retrier: Optional[Retrier] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        transport: Optional[Transport] = None,
+        session_cache: Optional[SessionCache] = None,
+        cache_key: Optional[str] = None,
+        on_response: Optional[Callable[[Request, ReqParams, Response], None]] = None,
     ) -> None:
+        """
+        With @session_cache, the session stored under @cache_key (the login by default)
+        is restored instead of refreshing the session eagerly; a missing or expired
+        session is refreshed lazily by the first request.
+        @on_response is called with every successful response, before it's unwrapped.
+        """
         if isinstance(api_key, str):
             api_key = bytes(api_key, encoding="ascii")
         self.api_key = api_key
         self.auto_refresh_session = auto_refresh_session
         self.device_id = device_id or AskfmApi.random_device_id()
         self.auth = auth
+        self.retrier = retrier or Retrier()
+        self.rate_limiter = rate_limiter
+        self.on_response = on_response
 
-        self.sess = Session()
+        self.transport = transport or Transport()
+        self.sess = self.transport.new_session()
         self.sess.headers.update(headers)
+        if self.transport.compress:
+            self.sess.headers["Accept-Encoding"] = "gzip, deflate"
+        # the rt chain only allows one request in flight per session
+        self._lock = threading.RLock()
         self.host = host
+        self.scheme = scheme
+
+        self.session_cache = session_cache
+        self.cache_key = cache_key or (auth[0].lower() if auth else None)
+        self._saved_at = 0.0
 
         if access_token is not None:
             self.access_token = access_token
@@ -93,7 +199,9 @@ class AskfmApi:
             # Seems that authenticated tokens start with ".3" and anon tokens with ".5".
         elif logged_in:
             raise TypeError("passed `logged_in` without `access_token`")
-        elif auto_refresh_session:
+        elif self.restore_session():
+            pass
+        elif auto_refresh_session and session_cache is None:
             self.refresh_session()
 
     @property
@@ -118,6 +226,7 @@ class AskfmApi:
         return self.refresh_session((username, password))
 
     def refresh_session(self, auth: Optional[Auth] = None) -> Optional[Response]:
+        user = None
         with self.disable_auto_refresh():  # guard against recursive refreshes
             # get initial anon token
             self.access_token = self.request(_r.get_access_token(self.device_id))
@@ -127,8 +236,36 @@ class AskfmApi:
                 res = self.request(_r.log_in(auth[0], auth[1], self.device_id))
                 self.access_token = res["accessToken"]
                 self.logged_in = True
-                return res["user"]
-        return None
+                user = res["user"]
+        self.save_session()
+        return user
+
+    def restore_session(self) -> bool:
+        """Load the cached session, return whether there was one."""
+        if self.session_cache is None or self.cache_key is None:
+            return False
+        state = self.session_cache.load(self.cache_key)
+        if state is None:
+            return False
+        self.device_id = state["device_id"]
+        self.access_token = state["access_token"]
+        self.rt = state["rt"]
+        self.logged_in = state["logged_in"]
+        return True
+
+    def save_session(self) -> None:
+        if self.session_cache is None or self.cache_key is None:
+            return
+        state = None
+        if self.access_token:
+            state = SessionState(
+                device_id=self.device_id,
+                access_token=self.access_token,
+                rt=self.rt,
+                logged_in=self.logged_in,
+            )
+        self.session_cache.save(self.cache_key, state)
+        self._saved_at = time.monotonic()
 
     def check_session(self) -> bool:
         with self.disable_auto_refresh():
@@ -161,38 +298,54 @@ class AskfmApi:
         if not self.access_token and self.auto_refresh_session:
             self.refresh_session()
 
-        if req.paginated:
-            if from_ts is None:
-                params = {"offset": offset, "limit": limit, **req.params}
-            else:
-                params = {"limit": limit, **req.params}
-                params["from"] = (
-                    from_ts  # req.params could have `from` and end up overriding the iterator value
-                )
-        else:
-            params = req.params
+        params = self._request_params(req, offset, from_ts, limit)
 
-        for i in itertools.count():
-            res = self.request_raw(req.method, req.path, params)
-            if "error" not in res:
-                break
-            error = AskfmApiError.from_response(res)
-            if not self.handle_error(error, req, i):
+        attempts: Counter[type] = Counter()
+        while True:
+            try:
+                res = self.request_raw(req.method, req.path, params)
+            except TransportError as e:
+                error = e
+            else:
+                if "error" not in res:
+                    self.retrier.on_success()
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.report(True)
+                    break
+                error = AskfmApiError.from_response(res)
+            if self.rate_limiter is not None:
+                self.rate_limiter.report_error(error)
+            if not self.handle_error(error, req, attempts[type(error)]):
                 raise error
+            attempts[type(error)] += 1
 
+        if self.on_response is not None:
+            self.on_response(req, params, res)
         if unwrap and req.unwrap_key:
             res = res[req.unwrap_key]
         return res
 
     def handle_error(self, error: AskfmApiError, req: Request, attempt_no: int) -> bool:
-        """Invalidate/refresh the session and return whether we should retry the request."""
+        """
+        Invalidate/refresh the session, wait out the backoff and return whether we should
+        retry the request. @attempt_no is the number of earlier failures of the same kind.
+        """
         if isinstance(error, SessionError):
             self.logged_in = False
             self.access_token = None
-            if attempt_no == 1 and self.auto_refresh_session:
-                self.refresh_session()
-                return True
-        return False
+            if not self.auto_refresh_session:
+                return False
+
+        delay = self.retrier.backoff(error, attempt_no)
+        if delay is None:
+            return False
+        logger.info(f"{req.name} failed with {error.code}, retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+        policy = self.retrier.policy_for(error)
+        if policy is not None and policy.refresh_session:
+            self.refresh_session()
+        return True
 
     def request_iter(
         self,
@@ -201,10 +354,26 @@ class AskfmApi:
         offset: int = 0,
         from_ts: int = None,
         page_limit: int = DEFAULT_LIMIT,
+        prefetch: int = 0,
     ) -> Iterator[Response]:
+        """
+        Iterate over the items of a paginated request.
+
+        With @prefetch > 0, up to that many pages are fetched ahead on a background
+        thread while the caller is still consuming the current one.
+        """
         if not req.paginated or not req.unwrap_key:
             raise TypeError("Cannot iterate non-paginated request")
 
+        pages = self._iter_pages(req, offset, from_ts, page_limit)
+        if prefetch > 0:
+            pages = self._prefetch_pages(pages, prefetch)
+        for items in pages:
+            yield from items
+
+    def _iter_pages(
+        self, req: Request, offset: int, from_ts: Optional[int], page_limit: int
+    ) -> Iterator[list[Response]]:
         while True:
             res = self.request(
                 req, from_ts=from_ts, offset=offset, limit=page_limit, unwrap=False
@@ -213,7 +382,7 @@ class AskfmApi:
             if not items:  # strangely, API always returns hasMore=True
                 break
 
-            yield from items
+            yield items
             # if not res.get("incomplete", False) and not res["hasMore"]:
             #     break
             offset += len(items)
@@ -223,47 +392,71 @@ class AskfmApi:
             if prev_ts is not None and prev_ts == from_ts:
                 break
 
-    def request_raw(
-        self, method: str, path: str, params: Optional[ReqParams] = None
-    ) -> Response:
-        params = params or {}
-        method = method.upper()
-        has_body = method in ["POST", "PUT"]
-        url = "https://" + self.host + path
-
-        params = {"rt": self.rt, "ts": int(time.time()), **params}
-        params = self.normalize_params(params)
-        if has_body:
-            params = {"json": json.dumps(params, sort_keys=True, separators=(",", ":"))}
-        signature = f"HMAC {self.get_signature(method, path, params)}"
-
-        res = self.sess.request(
-            method,
-            url,
-            data=params if has_body else None,
-            params=params if not has_body else None,
-            headers={"Authorization": signature},
-        )
+    def _prefetch_pages(
+        self, pages: Iterator[list[Response]], depth: int
+    ) -> Iterator[list[Response]]:
+        buffer: queue.Queue = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                with contextlib.suppress(queue.Full):
+                    buffer.put(item, timeout=0.1)
+                    return True
+            return False
 
-        if "X-Next-Token" in res.headers:
-            self.rt = res.headers["X-Next-Token"]
+        def produce():
+            try:
+                for page in pages:
+                    if not put(page):
+                        return
+            except BaseException as e:  # handed over to the consumer
+                put(e)
+            else:
+                put(done)
 
-        return res.json()
+        thread = threading.Thread(target=produce, name="page-prefetch", daemon=True)
+        thread.start()
+        try:
+            while (page := buffer.get()) is not done:
+                if isinstance(page, BaseException):
+                    raise page
+                yield page
+        finally:
+            stop.set()
+            thread.join()
 
-    def normalize_params(self, params: ReqParams) -> ReqParams:
-        result = {}
-        for k, v in params.items():
-            if v is None:
-                continue
-            if isinstance(v, (int, bool)):
-                v = str(v).lower()
-            result[k] = v
-        return result
+    def request_raw(
+        self, method: str, path: str, params: Optional[ReqParams] = None
+    ) -> Response:
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(path)
+        with self._lock:
+            url, params, has_body, headers = self._sign_request(method, path, params)
+
+            try:
+                res = self.sess.request(
+                    method.upper(),
+                    url,
+                    data=params if has_body else None,
+                    params=params if not has_body else None,
+                    headers=headers,
+                )
+            except RequestException as e:
+                raise TransportError.from_exception(e) from e
 
-    def get_signature(self, method: str, path: str, params: StrParams) -> str:
-        quoted = [key + "%" + quote(val, safe="!'()~") for (key, val) in params.items()]
-        msg = "%".join(sorted(quoted))
-        msg = "%".join([method.upper(), self.host, path, msg])
+            if "X-Next-Token" in res.headers:
+                self.rt = res.headers["X-Next-Token"]
+                # the next run can only reuse the session with the latest rt
+                if time.monotonic() - self._saved_at > SESSION_SAVE_INTERVAL:
+                    self.save_session()
 
-        hmac_ = hmac.new(self.api_key, msg.encode(), "sha1")
-        return hmac_.hexdigest()
+        retry_after = _parse_retry_after(res.headers.get("Retry-After"))
+        try:
+            body = res.json()
+        except ValueError as e:
+            raise TransportError.from_exception(e, retry_after) from e
+        if "error" in body and retry_after is not None:
+            body.setdefault("retryAfter", retry_after)
+        return body
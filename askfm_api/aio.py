@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import Counter
+from typing import AsyncIterator, Optional, Union
+
+import aiohttp
+
+import askfm_api
+from askfm_api import requests as _r
+from askfm_api.errors import (
+    AskfmApiError,
+    OperationError,
+    RequestError,
+    SessionError,
+    TransportError,
+)
+from askfm_api.ratelimit import RateLimiter
+from askfm_api.retry import Retrier
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAskfmApi(askfm_api._ApiBase):
+    """
+    asyncio variant of AskfmApi.
+
+    Requests are built and signed exactly like the sync client does, but many
+    of them can be in flight on one event loop (up to `max_concurrency`). The
+    request token chains the requests of a session, so a request is only signed
+    once the response headers of the previous one arrived; for requests that
+    really run in parallel, use one client per concurrent stream.
+    Unlike AskfmApi, the session is not refreshed in the constructor, it is
+    refreshed lazily on the first request instead.
+    """
+
+    headers: dict[str, str]
+    sess: Optional[aiohttp.ClientSession] = None
+
+    def __init__(
+        self,
+        api_key: Union[str, bytes],
+        *,
+        auto_refresh_session: bool = True,
+        device_id: Optional[str] = None,
+        access_token: Optional[str] = None,
+        logged_in: bool = False,
+        auth: Optional[askfm_api.Auth] = None,
+        host: str = askfm_api.DEFAULT_HOST,
+        scheme: str = "https",
+        headers: dict[str, str] = askfm_api.DEFAULT_HEADERS,
+        session: Optional[aiohttp.ClientSession] = None,
+        max_concurrency: int = 100,
+        retrier: Optional[Retrier] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        if isinstance(api_key, str):
+            api_key = bytes(api_key, encoding="ascii")
+        self.api_key = api_key
+        self.auto_refresh_session = auto_refresh_session
+        self.device_id = device_id or AsyncAskfmApi.random_device_id()
+        self.auth = auth
+        self.retrier = retrier or Retrier()
+        self.rate_limiter = rate_limiter
+
+        self.headers = dict(headers)
+        self.host = host
+        self.scheme = scheme
+        self.sess = session
+        self._own_sess = session is None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._refresh_lock = asyncio.Lock()
+        # held from signing a request until its response brings the next rt
+        self._rt_lock = asyncio.Lock()
+
+        if access_token is not None:
+            self.access_token = access_token
+            self.logged_in = logged_in
+        elif logged_in:
+            raise TypeError("passed `logged_in` without `access_token`")
+
+    async def __aenter__(self) -> AsyncAskfmApi:
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self.sess is not None and self._own_sess:
+            await self.sess.close()
+            self.sess = None
+
+    @property
+    def access_token(self) -> Optional[str]:
+        return self._access_token
+
+    @access_token.setter
+    def access_token(self, token: Optional[str]) -> None:
+        self._access_token = token
+        if token is None:
+            self.headers.pop("X-Access-Token", None)
+        else:
+            self.headers["X-Access-Token"] = token
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+    @host.setter
+    def host(self, host: str) -> None:
+        self._host = host
+        self.headers["Host"] = host
+
+    async def log_in(self, username: str, password: str) -> askfm_api.Response:
+        return await self.refresh_session((username, password))
+
+    async def refresh_session(
+        self, auth: Optional[askfm_api.Auth] = None
+    ) -> Optional[askfm_api.Response]:
+        async with self._refresh_lock:
+            return await self._refresh_session(auth)
+
+    async def _refresh_session(
+        self, auth: Optional[askfm_api.Auth]
+    ) -> Optional[askfm_api.Response]:
+        # get initial anon token
+        self.access_token = await self._request(
+            _r.get_access_token(self.device_id), refresh=False
+        )
+        self.logged_in = False
+        if auth := (auth or self.auth):
+            # get user token
+            res = await self._request(
+                _r.log_in(auth[0], auth[1], self.device_id), refresh=False
+            )
+            self.access_token = res["accessToken"]
+            self.logged_in = True
+            return res["user"]
+        return None
+
+    async def check_session(self) -> bool:
+        try:
+            await self._request(_r.fetch_my_profile(), refresh=False)
+        except (RequestError, OperationError):
+            self.logged_in = False
+            self.access_token = None
+            return False
+        self.logged_in = True
+        return True
+
+    async def request(
+        self,
+        req: askfm_api.Request,
+        *,
+        unwrap: bool = True,
+        offset: int = 0,
+        from_ts: int = None,
+        limit: int = askfm_api.DEFAULT_LIMIT,
+    ) -> askfm_api.Response:
+        return await self._request(
+            req,
+            refresh=self.auto_refresh_session,
+            unwrap=unwrap,
+            offset=offset,
+            from_ts=from_ts,
+            limit=limit,
+        )
+
+    async def _request(
+        self,
+        req: askfm_api.Request,
+        *,
+        refresh: bool,
+        unwrap: bool = True,
+        offset: int = 0,
+        from_ts: int = None,
+        limit: int = askfm_api.DEFAULT_LIMIT,
+    ) -> askfm_api.Response:
+        if not self.access_token and refresh:
+            await self._ensure_session(None)
+
+        params = self._request_params(req, offset, from_ts, limit)
+
+        attempts: Counter[type] = Counter()
+        while True:
+            token = self.access_token
+            try:
+                res = await self.request_raw(req.method, req.path, params)
+            except TransportError as e:
+                error = e
+            else:
+                if "error" not in res:
+                    self.retrier.on_success()
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.report(True)
+                    break
+                error = AskfmApiError.from_response(res)
+            if self.rate_limiter is not None:
+                self.rate_limiter.report_error(error)
+            attempt_no = attempts[type(error)]
+            if not await self.handle_error(error, req, attempt_no, token, refresh):
+                raise error
+            attempts[type(error)] += 1
+
+        if unwrap and req.unwrap_key:
+            res = res[req.unwrap_key]
+        return res
+
+    async def _ensure_session(self, stale_token: Optional[str]) -> None:
+        """Refresh the session unless a concurrent request already replaced @stale_token."""
+        async with self._refresh_lock:
+            if self.access_token and self.access_token != stale_token:
+                return
+            await self._refresh_session(None)
+
+    async def handle_error(
+        self,
+        error: AskfmApiError,
+        req: askfm_api.Request,
+        attempt_no: int,
+        token: Optional[str] = None,
+        refresh: bool = True,
+    ) -> bool:
+        """
+        Invalidate/refresh the session, wait out the backoff and return whether we should
+        retry the request. @attempt_no is the number of earlier failures of the same kind.
+        """
+        if isinstance(error, SessionError) and not refresh:
+            if self.access_token == token:
+                self.logged_in = False
+                self.access_token = None
+            return False
+
+        delay = self.retrier.backoff(error, attempt_no)
+        if delay is None:
+            return False
+        logger.info(f"{req.name} failed with {error.code}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+        policy = self.retrier.policy_for(error)
+        if policy is not None and policy.refresh_session:
+            await self._ensure_session(token)
+        return True
+
+    async def request_iter(
+        self,
+        req: askfm_api.Request,
+        *,
+        offset: int = 0,
+        from_ts: int = None,
+        page_limit: int = askfm_api.DEFAULT_LIMIT,
+    ) -> AsyncIterator[askfm_api.Response]:
+        if not req.paginated or not req.unwrap_key:
+            raise TypeError("Cannot iterate non-paginated request")
+
+        while True:
+            res = await self.request(
+                req, from_ts=from_ts, offset=offset, limit=page_limit, unwrap=False
+            )
+            items = res[req.unwrap_key]
+            if not items:  # strangely, API always returns hasMore=True
+                break
+
+            for item in items:
+                yield item
+            offset += len(items)
+            prev_ts = from_ts
+            from_ts = items[-1].get("ts")
+
+            if prev_ts is not None and prev_ts == from_ts:
+                break
+
+    async def request_raw(
+        self,
+        method: str,
+        path: str,
+        params: Optional[askfm_api.ReqParams] = None,
+    ) -> askfm_api.Response:
+        if self.sess is None:
+            self.sess = aiohttp.ClientSession()
+
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async(path)
+        async with self._semaphore:
+            await self._rt_lock.acquire()
+            signing = True
+            try:
+                url, params, has_body, headers = self._sign_request(
+                    method, path, params
+                )
+                async with self.sess.request(
+                    method.upper(),
+                    url,
+                    data=params if has_body else None,
+                    params=params if not has_body else None,
+                    headers={**self.headers, **headers},
+                ) as res:
+                    if "X-Next-Token" in res.headers:
+                        self.rt = res.headers["X-Next-Token"]
+                    # the next request can be signed while the body is read
+                    self._rt_lock.release()
+                    signing = False
+                    retry_after = askfm_api._parse_retry_after(
+                        res.headers.get("Retry-After")
+                    )
+                    body = await res.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise TransportError.from_exception(e) from e
+            except ValueError as e:
+                raise TransportError.from_exception(e, retry_after) from e
+            finally:
+                if signing:
+                    self._rt_lock.release()
+
+        if "error" in body and retry_after is not None:
+            body.setdefault("retryAfter", retry_after)
+        return body
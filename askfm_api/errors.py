@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from typing import Type
+import contextlib
+from typing import Optional, Type
 
 import askfm_api
 
@@ -8,11 +9,15 @@ import askfm_api
 class AskfmApiError(Exception):
     """Base class for all errors in askfm_api."""
 
+    retry_after: Optional[float] = None
+
     def __init__(self, response: askfm_api.Response) -> None:
         code = response["error"]
         super().__init__(code)
         self.response = response
         self.code = code
+        with contextlib.suppress(KeyError, TypeError, ValueError):
+            self.retry_after = float(response["retryAfter"])
 
     @staticmethod
     def from_response(response: askfm_api.Response) -> AskfmApiError:
@@ -41,6 +46,23 @@ class SessionError(RequestError):
     """Error that should go away after refreshing the session token."""
 
 
+class NetworkError(RequestError):
+    """The server reports a temporary network problem on its side."""
+
+
+class TransportError(RequestError):
+    """The request never got a proper API response: connection reset, timeout, non-JSON body."""
+
+    @staticmethod
+    def from_exception(
+        exc: BaseException, retry_after: Optional[float] = None
+    ) -> TransportError:
+        response = {"error": "transport_error", "message": str(exc)}
+        if retry_after is not None:
+            response["retryAfter"] = retry_after
+        return TransportError(response)
+
+
 # I tried my best at guessing the meanings of these codes, but didn't check it.
 ERROR_CODE_MAP: dict[str, Type[AskfmApiError]] = {
     "account_banned": OperationError,  # account_banned
@@ -71,7 +93,7 @@ ERROR_CODE_MAP: dict[str, Type[AskfmApiError]] = {
     "invalid_user_credentials": OperationError,  # invalid_user_credentials
     "ip_banned": RequestError,  # ip_banned
     "limit_exceeded": OperationError,  # pinned_answers_limit_exceeded
-    "network_error": RequestError,  # network_error
+    "network_error": NetworkError,  # network_error
     "not_allowed": RequestError,  # not_allowed
     "session_expired": SessionError,  # session_expired
     "session_invalid": SessionError,  # session_invalid
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import contextlib
+import queue
+import threading
+from typing import Iterator, Optional, Union
+
+import askfm_api
+
+
+class AskfmApiPool:
+    """
+    A pool of independent AskfmApi sessions.
+
+    Every session has its own device id, access token and `rt` chain, so
+    requests issued through different sessions can run in parallel without
+    tripping `invalid_request_token`. Sessions are created lazily, up to `size`.
+    """
+
+    api_key: Union[str, bytes]
+    size: int
+    auth: Optional[askfm_api.Auth]
+
+    def __init__(
+        self,
+        api_key: Union[str, bytes],
+        size: int = 4,
+        *,
+        auth: Optional[askfm_api.Auth] = None,
+        **api_kwargs,
+    ) -> None:
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        self.api_key = api_key
+        self.size = size
+        self.auth = auth
+        # one retry budget for the whole pool
+        api_kwargs.setdefault("retrier", askfm_api.Retrier())
+        self.api_kwargs = api_kwargs
+
+        self._sessions: list[Optional[askfm_api.AskfmApi]] = [None] * size
+        self._free_slots = list(reversed(range(size)))
+        self._idle: queue.LifoQueue[askfm_api.AskfmApi] = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _new_session(self, slot: int) -> askfm_api.AskfmApi:
+        kwargs = dict(self.api_kwargs)
+        if self.auth and "session_cache" in kwargs:
+            # every slot keeps its own cached session and rt chain
+            kwargs.setdefault("cache_key", f"{self.auth[0].lower()}#{slot}")
+        return askfm_api.AskfmApi(self.api_key, auth=self.auth, **kwargs)
+
+    def _acquire(self, timeout: Optional[float]) -> askfm_api.AskfmApi:
+        with contextlib.suppress(queue.Empty):
+            return self._idle.get_nowait()
+
+        with self._lock:
+            # reserve the slot before the (slow) login round trips
+            slot = self._free_slots.pop() if self._free_slots else None
+
+        if slot is None:
+            return self._idle.get(timeout=timeout)
+
+        try:
+            api = self._new_session(slot)
+        except BaseException:
+            with self._lock:
+                self._free_slots.append(slot)
+            raise
+
+        with self._lock:
+            self._sessions[slot] = api
+        return api
+
+    @contextlib.contextmanager
+    def lease(self, timeout: Optional[float] = None) -> Iterator[askfm_api.AskfmApi]:
+        """Borrow a session for exclusive use, blocking while all are busy."""
+        api = self._acquire(timeout)
+        try:
+            yield api
+        finally:
+            self._idle.put(api)
+
+    def log_in(self, username: str, password: str) -> askfm_api.Response:
+        self.auth = (username, password)
+        self.invalidate()
+        with self.lease() as api:
+            return api.log_in(username, password)
+
+    def invalidate(self) -> None:
+        """Drop the tokens of every session, they get refreshed on their next request."""
+        with self._lock:
+            sessions = [api for api in self._sessions if api is not None]
+        for api in sessions:
+            api.auth = self.auth
+            api.logged_in = False
+            api.access_token = None
+
+    def save_sessions(self) -> None:
+        with self._lock:
+            sessions = [api for api in self._sessions if api is not None]
+        for api in sessions:
+            api.save_session()
+
+    def request(self, req: askfm_api.Request, **kwargs) -> askfm_api.Response:
+        with self.lease() as api:
+            return api.request(req, **kwargs)
+
+    def request_iter(
+        self, req: askfm_api.Request, **kwargs
+    ) -> Iterator[askfm_api.Response]:
+        # the whole iteration stays on one session
+        with self.lease() as api:
+            yield from api.request_iter(req, **kwargs)
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from .errors import AskfmApiError, NetworkError, TransportError, TryAgainError
+
+DEFAULT_KEY = "*"
+
+# errors that mean we are going too fast
+THROTTLE_ERRORS = (TryAgainError, NetworkError, TransportError)
+THROTTLE_CODES = {"ip_banned"}
+
+Limits = dict[str, tuple[float, int]]  # key -> (requests per second, burst)
+
+
+def is_throttle_error(error: AskfmApiError) -> bool:
+    return isinstance(error, THROTTLE_ERRORS) or error.code in THROTTLE_CODES
+
+
+class MemoryBucketStore:
+    """Token buckets kept in memory, shared by the threads of one process."""
+
+    def __init__(self) -> None:
+        # key -> (tokens, updated_at)
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        """Take a token from bucket @key, return 0 on success or the seconds to wait."""
+        with self._lock:
+            now = time.time()
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            return wait
+
+
+class SqliteBucketStore:
+    """
+    Token buckets kept in an SQLite file, so that every process on the host
+    that points at the same file shares one budget.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets "
+            "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        with self._lock:
+            db = self._db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = db.execute(
+                    "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, updated_at = row if row is not None else (burst, now)
+                tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                db.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            return wait
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter for every request that leaves the process.
+
+    Requests are charged to the bucket configured for their key (the API path,
+    or e.g. "media" for downloads) in @limits, and to the default bucket otherwise.
+    In adaptive mode the rates are halved whenever the server pushes back, and
+    slowly recover while requests succeed.
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        burst: int = 20,
+        *,
+        limits: Optional[Limits] = None,
+        adaptive: bool = False,
+        min_factor: float = 0.05,
+        recovery: float = 0.01,
+        store: Optional[MemoryBucketStore | SqliteBucketStore] = None,
+    ) -> None:
+        self.limits: Limits = {DEFAULT_KEY: (rate, burst), **(limits or {})}
+        self.adaptive = adaptive
+        self.min_factor = min_factor
+        self.recovery = recovery
+        self.store = store or MemoryBucketStore()
+        self.factor = 1.0
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: str) -> tuple[str, float, int]:
+        if key not in self.limits:
+            key = DEFAULT_KEY
+        rate, burst = self.limits[key]
+        return key, max(rate * self.factor, 1e-3), burst
+
+    def reserve(self, key: str) -> float:
+        """Take a token for @key without blocking, return 0 or the seconds to wait."""
+        bucket, rate, burst = self._bucket(key)
+        return self.store.take(bucket, rate, burst)
+
+    def acquire(self, key: str) -> None:
+        while (wait := self.reserve(key)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, key: str) -> None:
+        while (wait := self.reserve(key)) > 0:
+            await asyncio.sleep(wait)
+
+    def report(self, ok: bool) -> None:
+        """Feed the outcome of a request to the adaptive mode."""
+        if not self.adaptive:
+            return
+        with self._lock:
+            if ok:
+                self.factor = min(1.0, self.factor + self.recovery)
+            else:
+                self.factor = max(self.min_factor, self.factor / 2)
+
+    def report_error(self, error: AskfmApiError) -> None:
+        if is_throttle_error(error):
+            self.report(False)
@@ -131,8 +131,8 @@ def send_question(users: list[str], text: str, *, anon: bool = False):
 
 
 @make_req("GET", "/answers/chats", paginated=False, item_id_key="qid")
-def fetch_chats(qid: str, *, limit: Optional[int] = 100):
-    return {"qid": qid, "limit": limit}
+def fetch_chats(qid: str, *, limit: Optional[int] = 100, from_ts: Optional[int] = None):
+    return {"qid": qid, "limit": limit, "from": from_ts}
 
 
 @make_req(
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import logging
+import random
+import threading
+from dataclasses import dataclass
+from typing import Optional, Type
+
+from .errors import (
+    AskfmApiError,
+    NetworkError,
+    SessionError,
+    TransportError,
+    TryAgainError,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RetryPolicy:
+    max_retries: int
+    base_delay: float = 1.0  # seconds, doubled on every attempt
+    max_delay: float = 60.0
+    refresh_session: bool = False
+
+
+# Looked up along the MRO of the raised error, so subclasses inherit the policy
+# of their parent unless they have their own.
+DEFAULT_POLICIES: dict[Type[AskfmApiError], RetryPolicy] = {
+    SessionError: RetryPolicy(max_retries=1, base_delay=0, refresh_session=True),
+    TryAgainError: RetryPolicy(max_retries=6, base_delay=2.0, max_delay=120.0),
+    NetworkError: RetryPolicy(max_retries=5, base_delay=2.0, max_delay=120.0),
+    TransportError: RetryPolicy(max_retries=5, base_delay=1.0, max_delay=60.0),
+}
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of the successful requests, so that a struggling
+    server doesn't get hammered with retries on top of the regular traffic.
+    """
+
+    def __init__(
+        self, ratio: float = 0.2, min_tokens: float = 10, max_tokens: float = 100
+    ):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = min_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Retrier:
+    """Decides whether and when a failed request is retried."""
+
+    def __init__(
+        self,
+        policies: Optional[dict[Type[AskfmApiError], RetryPolicy]] = None,
+        budget: Optional[RetryBudget] = None,
+    ) -> None:
+        self.policies = DEFAULT_POLICIES if policies is None else policies
+        self.budget = budget or RetryBudget()
+
+    def policy_for(self, error: AskfmApiError) -> Optional[RetryPolicy]:
+        for cls in type(error).__mro__:
+            if cls in self.policies:
+                return self.policies[cls]
+        return None
+
+    def on_success(self) -> None:
+        self.budget.deposit()
+
+    def backoff(self, error: AskfmApiError, attempt_no: int) -> Optional[float]:
+        """
+        Return how many seconds to wait before retrying attempt @attempt_no
+        (0-based), or None if the request shouldn't be retried.
+        """
+        policy = self.policy_for(error)
+        if policy is None or attempt_no >= policy.max_retries:
+            return None
+        if not self.budget.withdraw():
+            logger.warning(f"retry budget exhausted, giving up on {error.code}")
+            return None
+
+        # "full jitter" exponential backoff
+        cap = min(policy.max_delay, policy.base_delay * 2**attempt_no)
+        delay = random.uniform(0, cap)
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        return delay
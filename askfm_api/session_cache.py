@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import tempfile
+import threading
+from typing import Optional, TypedDict
+
+
+class SessionState(TypedDict):
+    device_id: str
+    access_token: str
+    rt: str
+    logged_in: bool
+
+
+class SessionCache:
+    """
+    Stores the session state (device id, access token and current `rt`) of each
+    account in a JSON file, so that a new process can pick up where the previous
+    one stopped instead of logging in again.
+
+    The cached token is not validated when it is loaded: the first request that
+    fails with a SessionError goes through the usual refresh path.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict[str, SessionState]:
+        with contextlib.suppress(FileNotFoundError, ValueError):
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                return data
+        return {}
+
+    def load(self, key: str) -> Optional[SessionState]:
+        with self._lock:
+            state = self._read().get(key)
+        if not state or not state.get("access_token"):
+            return None
+        return state
+
+    def save(self, key: str, state: Optional[SessionState]) -> None:
+        """Store @state under @key, or forget @key if @state is None."""
+        with self._lock:
+            data = self._read()
+            if state is None:
+                data.pop(key, None)
+            else:
+                data[key] = state
+
+            # the file holds credentials, so keep it private and never half-written
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".session-")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f)
+                os.chmod(tmp, 0o600)
+                os.replace(tmp, self.path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp)
+                raise
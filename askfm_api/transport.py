@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import threading
+from collections import defaultdict
+from typing import Optional, Union
+from urllib.parse import urlsplit
+
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+
+Timeout = Union[float, tuple[float, float]]  # (connect, read)
+
+DEFAULT_TIMEOUT: tuple[float, float] = (10.0, 60.0)
+
+
+class TransportSession(Session):
+    """A requests Session that uses the transport's pools, timeouts and accounting."""
+
+    def __init__(self, transport: Transport) -> None:
+        super().__init__()
+        self.transport = transport
+        for prefix, adapter in transport.adapters.items():
+            self.mount(prefix, adapter)
+
+    def request(self, method, url, *args, **kwargs) -> Response:
+        kwargs.setdefault("timeout", self.transport.timeout)
+        res = super().request(method, url, *args, **kwargs)
+        if not kwargs.get("stream"):
+            self.transport.account(url, res)
+        return res
+
+
+class Transport:
+    """
+    HTTP transport shared by the API clients and the media downloader.
+
+    All sessions created by `new_session` share the same connection pools, so
+    keep-alive connections (and TLS handshakes) are reused across sessions and
+    threads, while every session keeps its own headers.
+    """
+
+    def __init__(
+        self,
+        *,
+        pool_maxsize: int = 10,
+        host_pool_sizes: Optional[dict[str, int]] = None,
+        timeout: Timeout = DEFAULT_TIMEOUT,
+        compress: bool = False,
+    ) -> None:
+        """
+        @pool_maxsize keep-alive connections kept per host
+        @host_pool_sizes overrides of @pool_maxsize keyed by url prefix, e.g. "https://api.ask.fm"
+        @timeout connect/read timeout applied to requests that don't pass their own
+        @compress ask the API for gzip'ed responses instead of identity
+        """
+        self.timeout = timeout
+        self.compress = compress
+        self.adapters: dict[str, HTTPAdapter] = {
+            "https://": HTTPAdapter(pool_maxsize=pool_maxsize),
+            "http://": HTTPAdapter(pool_maxsize=pool_maxsize),
+        }
+        for prefix, size in (host_pool_sizes or {}).items():
+            self.adapters[prefix] = HTTPAdapter(pool_maxsize=size)
+
+        self._default_session: Optional[TransportSession] = None
+        self._stats: defaultdict[str, dict[str, int]] = defaultdict(
+            lambda: {"requests": 0, "bytes": 0}
+        )
+        self._lock = threading.Lock()
+
+    def new_session(self) -> TransportSession:
+        return TransportSession(self)
+
+    @property
+    def session(self) -> TransportSession:
+        """A session without any particular headers, e.g. for media downloads."""
+        if self._default_session is None:
+            self._default_session = self.new_session()
+        return self._default_session
+
+    def get(self, url: str, **kwargs) -> Response:
+        return self.session.get(url, **kwargs)
+
+    def account(self, url: str, res: Response, nbytes: Optional[int] = None) -> None:
+        """Record the bytes received for @res, as transferred on the wire when known."""
+        if nbytes is None:
+            nbytes = _wire_bytes(res)
+        res.wire_bytes = nbytes
+        host = urlsplit(url).netloc
+        with self._lock:
+            self._stats[host]["requests"] += 1
+            self._stats[host]["bytes"] += nbytes
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """Requests and received bytes per host."""
+        with self._lock:
+            return {host: dict(stats) for host, stats in self._stats.items()}
+
+    def close(self) -> None:
+        for adapter in self.adapters.values():
+            adapter.close()
+
+
+def _wire_bytes(res: Response) -> int:
+    # urllib3 counts the (possibly compressed) bytes it read off the socket
+    raw = getattr(res, "raw", None)
+    tell = getattr(raw, "tell", None)
+    if tell is not None:
+        try:
+            nbytes = tell()
+        except (OSError, ValueError):
+            nbytes = 0
+        if nbytes:
+            return nbytes
+    return len(res.content)
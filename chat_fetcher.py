@@ -0,0 +1,118 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+from askfm_api import AskfmApiError, AskfmApiPool
+from askfm_api import requests as r
+from askfm_model import askFMChat
+from database import ChatStateModel
+
+
+def empty_chat(qid: int) -> askFMChat:
+    """The chat of an answer that has none (yet)."""
+    return askFMChat(root={"qid": qid}, messages=[], hasOlder=False, owner=None)
+
+
+class ChatFetcher:
+    """
+    Fetches chats on a bounded pool of worker threads.
+
+    Every request leases its own session from @pool, since the request token
+    (`rt`) is chained per session and can't be shared by concurrent requests.
+    """
+
+    def __init__(self, pool: AskfmApiPool, workers: int | None = None):
+        self.logger = logging.getLogger(__name__)
+        self.pool = pool
+        self.workers = max(1, workers or pool.size)
+        self.max_pending = self.workers * 8
+
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="chat-fetcher"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fetch(self, qid: int, state: ChatStateModel | None = None) -> askFMChat | None:
+        """
+        Fetches the chat of @qid, paging back through older messages until the
+        ones known from @state are reached, or all of them without a @state.
+        A chat that doesn't exist is returned without messages, None means
+        that it couldn't be retrieved.
+        """
+        known = None
+        if state is not None:
+            known = state["last_message_at"]
+        try:
+            chat = self.pool.request(r.fetch_chats(qid=qid))
+            page = chat
+            while page.get("hasOlder") and page.get("messages"):
+                oldest = min(message["createdAt"] for message in page["messages"])
+                if known is not None and oldest <= known:
+                    # the rest was fetched by an earlier run
+                    chat["hasOlder"] = state["has_older"]
+                    break
+                page = self.pool.request(r.fetch_chats(qid=qid, from_ts=oldest))
+                older = page.get("messages") or []
+                if any(message["createdAt"] >= oldest for message in older):
+                    # the API ignored `from`, don't loop over the same page
+                    self.logger.warning(f"can't page back through chat of qid={qid}")
+                    break
+                chat["messages"] = older + chat["messages"]
+                chat["hasOlder"] = page.get("hasOlder", False)
+        except AskfmApiError as e:
+            if str(e) == "data_not_found":
+                return empty_chat(qid)
+            self.logger.error(f"error when retrieveing chat for qid={qid}: {e}")
+            return None
+        else:
+            return chat
+
+    def submit(self, qid: int, state: ChatStateModel | None = None) -> Future:
+        """
+        Schedules the chat of @qid for fetching. Blocks when too many
+        requests are already pending so that the caller can't run away.
+        """
+        self._pending.acquire()
+        future = self._executor.submit(self.fetch, qid, state)
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def collect(self, futures: Iterable[Future]) -> list[askFMChat]:
+        """
+        Waits for @futures and returns the fetched chats in submission order,
+        leaving out the ones that couldn't be retrieved.
+        """
+        chats = []
+        for future in futures:
+            chat = future.result()
+            if chat is not None:
+                chats.append(chat)
+        return chats
+
+    def map(
+        self, qids: Iterable[int], states: dict[int, ChatStateModel] | None = None
+    ) -> Iterator[askFMChat | None]:
+        """
+        Fetches the chats of @qids concurrently and yields them in order.
+        None is yielded for the chats that couldn't be retrieved.
+        """
+        states = states or {}
+        window: deque[Future] = deque()
+        for qid in qids:
+            if len(window) >= self.max_pending:
+                yield window.popleft().result()
+            window.append(self.submit(qid, states.get(qid)))
+
+        while window:
+            yield window.popleft().result()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
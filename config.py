@@ -2,4 +2,51 @@ output_directory = "./output"
 username = ""  # askfm username
 password = ""  # askfm password
 db_file = "./askfm.db"
+db_timeout = 60.0  # seconds a write waits for another process holding the database lock
 key = ""  # api key
+chat_workers = 4  # number of concurrent API sessions used to fetch chats
+# most chats of a profile refreshed per run, recently active first
+chat_refresh_limit = 100
+# seconds before a chat is refreshed again, at the least
+chat_refresh_min_interval = 3600
+prefetch_pages = 2  # profile stream pages fetched ahead while processing, 0 disables it
+crawl_shards = 1  # time windows crawled concurrently when archiving a whole profile
+jobs = 1  # profiles archived in parallel, each in its own process
+watch_min_interval = 15 * 60  # seconds, --watch checks a profile at most this often
+watch_max_interval = 7 * 24 * 3600  # and at least this often
+# requests per hour --watch may spend, media downloads included
+watch_request_budget = 3000
+media_workers = 8  # visuals downloaded at the same time
+media_per_host = 4  # and at most this many from the same host
+# seconds before askfm-media retries a failed download, doubled every time
+media_retry_delay = 10 * 60
+media_retry_max_delay = 7 * 24 * 3600
+media_max_attempts = 10  # a download is given up after this many failures
+# seconds a download is reserved for the askfm-media run that took it
+media_claim_lease = 15 * 60
+# "content" keeps a single copy of identical visuals, "pack" appends them to pack files, see README
+media_store = "files"
+# bytes, a new pack file is started after this size
+media_pack_size = 1024 * 1024 * 1024
+rate_limit = 10.0  # API requests per second, shared by every session of the process
+rate_burst = 20
+# per path budgets, e.g. "/answers/chats": (5.0, 10)
+rate_limits = {"media": (20.0, 40)}
+rate_limit_adaptive = True  # slow down when the server starts throttling
+# sqlite file that shares the budget between processes, empty to disable
+rate_limit_db = ""
+http_pool_size = 10  # keep-alive connections per host
+http_connect_timeout = 10  # seconds
+http_read_timeout = 60  # seconds
+http_compress = True  # request gzip'ed API responses
+# reuse the login between runs, empty to disable
+session_cache_file = "./.askfm_session.json"
+api_host = "api.ask.fm:443"  # e.g. "127.0.0.1:8080" for tools/fake_server.py
+api_scheme = "https"  # "http" for tools/fake_server.py
+# keep the raw API responses here for reprocess.py, empty to disable
+raw_archive_directory = ""
+raw_archive_segment_size = 64 * 1024 * 1024  # uncompressed bytes per segment file
+pipeline_queue_size = 1000  # items buffered between the extraction stages
+progress_interval = 0.25  # seconds between redraws of the progress line on a terminal
+# seconds between JSON progress summaries when not on a terminal
+progress_log_interval = 10
@@ -0,0 +1,185 @@
+import bisect
+import contextlib
+import logging
+import queue
+import threading
+import time
+from array import array
+from typing import Iterable, Iterator
+
+from askfm_api import AskfmApiPool
+from askfm_api import requests as r
+from askfm_model import AskFM
+from database import ChatStateModel
+
+# ask.fm launched in June 2010, nothing on a profile stream is older than that
+ASKFM_LAUNCH_TS = 1276646400
+
+logger = logging.getLogger(__name__)
+
+
+def _item_ts(item: AskFM) -> int | None:
+    ts = item.get("ts")
+    if ts is None:
+        ts = item.get("data", {}).get("answer", {}).get("createdAt")
+    return ts
+
+
+def time_windows(lower_ts: int, upper_ts: int, shards: int) -> list[tuple[int, int]]:
+    """
+    Splits [@lower_ts, @upper_ts] into @shards windows of equal length.
+    Windows are returned newest first as (upper, lower) pairs.
+    """
+    shards = max(1, shards)
+    step = max(1, (upper_ts - lower_ts) // shards)
+    bounds = [upper_ts - i * step for i in range(shards)] + [lower_ts]
+    return [(bounds[i], bounds[i + 1]) for i in range(shards)]
+
+
+def coverage_gaps(
+    intervals: list[tuple[int, int]], lower_ts: int, upper_ts: int
+) -> list[tuple[int, int]]:
+    """
+    The parts of [@lower_ts, @upper_ts] that aren't in the sorted, disjoint,
+    inclusive @intervals. Gaps are returned newest first as (upper, lower) windows,
+    upper being exclusive like the `from` of the profile stream.
+    """
+    gaps = []
+    for from_ts, to_ts in reversed(intervals):
+        if to_ts < upper_ts:
+            gaps.append((upper_ts + 1, max(to_ts + 1, lower_ts)))
+        upper_ts = min(upper_ts, from_ts - 1)
+        if upper_ts < lower_ts:
+            return gaps
+    gaps.append((upper_ts + 1, lower_ts))
+    return gaps
+
+
+class KnownAnswers:
+    """
+    The answers already stored for a profile, as sorted qids and their like counts
+    in two compact arrays, so that a crawl over an archived profile can tell
+    the items it already has without a database round trip per item. The states
+    of their chats are kept too, so only the new messages of a chat are fetched.
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[tuple[int, int]],
+        chat_states: dict[int, ChatStateModel] | None = None,
+    ):
+        """@rows (qid, like_count) sorted by qid"""
+        self.chat_states = chat_states or {}
+        self.qids = array("q")
+        self.likes = array("q")
+        for qid, like_count in rows:
+            self.qids.append(qid)
+            self.likes.append(like_count or 0)
+
+    def __len__(self) -> int:
+        return len(self.qids)
+
+    def like_count(self, qid: int) -> int | None:
+        """The stored like count of @qid, None if it isn't stored"""
+        i = bisect.bisect_left(self.qids, qid)
+        if i < len(self.qids) and self.qids[i] == qid:
+            return self.likes[i]
+        return None
+
+    def chat_state(self, qid: int) -> ChatStateModel | None:
+        return self.chat_states.get(qid)
+
+
+def sharded_profile_stream(
+    pool: AskfmApiPool,
+    username: str,
+    shards: int,
+    upper_ts: int | None = None,
+    lower_ts: int = ASKFM_LAUNCH_TS,
+    prefetch: int = 0,
+    windows: list[tuple[int, int]] | None = None,
+) -> Iterator[AskFM]:
+    """
+    Crawls the profile stream of @username with @shards concurrent cursors, each
+    starting at the upper bound of its own time window and stopping once it
+    reaches the next window. Items are yielded as soon as any shard produces
+    them, so they are NOT in timeline order; duplicates are filtered by qid.
+
+    @windows (upper, lower) pairs to crawl instead of splitting [@lower_ts, @upper_ts],
+        e.g. to resume an interrupted crawl. At most @shards of them are crawled at a time.
+    """
+    if windows is None:
+        if upper_ts is None:
+            upper_ts = int(time.time())
+        windows = time_windows(lower_ts, int(upper_ts), shards)
+
+    items: queue.Queue = queue.Queue(maxsize=len(windows) * 1000)
+    stop = threading.Event()
+    done = object()
+    running = threading.Semaphore(max(1, shards))
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            with contextlib.suppress(queue.Full):
+                items.put(item, timeout=0.1)
+                return True
+        return False
+
+    def crawl(upper: int, lower: int):
+        while not running.acquire(timeout=0.1):
+            if stop.is_set():
+                return
+        count = 0
+        try:
+            stream = pool.request_iter(
+                r.fetch_profile_stream(
+                    username=username, skip="answer_chats", from_ts=upper
+                ),
+                prefetch=prefetch,
+            )
+            for item in stream:
+                ts = _item_ts(item)
+                # `from` is exclusive, so the next shard starts below `lower` and
+                # an item exactly on the boundary belongs to this shard only
+                if ts is not None and ts < lower:
+                    break
+                if not put(item):
+                    break
+                count += 1
+            stream.close()
+        except BaseException as e:  # handed over to the consumer
+            put(e)
+        else:
+            logger.debug(f"shard [{lower}, {upper}] finished with {count} items")
+            put(done)
+        finally:
+            running.release()
+
+    threads = [
+        threading.Thread(target=crawl, args=window, name="shard", daemon=True)
+        for window in windows
+    ]
+    for thread in threads:
+        thread.start()
+
+    seen: set[int] = set()
+    remaining = len(threads)
+    try:
+        while remaining > 0:
+            item = items.get()
+            if item is done:
+                remaining -= 1
+                continue
+            if isinstance(item, BaseException):
+                raise item
+
+            qid = item.get("data", {}).get("qid")
+            if qid is not None:
+                if qid in seen:
+                    continue
+                seen.add(qid)
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -1,10 +1,17 @@
+import contextlib
 import logging
 import os
+import re
 import sqlite3
-from typing import TypedDict
+from typing import Iterator, TypedDict
 
 import config
 
+MIGRATIONS_DIRECTORY = "./sqlite/migrations"
+
+# database files whose schema is known to be up to date in this process
+_migrated: set[str] = set()
+
 
 class QuestionModel(TypedDict):
     qid: int  # primary
@@ -41,6 +48,7 @@ class VisualModel(TypedDict):
     id: str
     type: str  # gif, photo, video
     directory: str  # relative to visuals directory
+    blob: str | None  # sha256 of the content, once it's in the content store
 
 
 class QueueModel(TypedDict):
@@ -50,6 +58,13 @@ class QueueModel(TypedDict):
     url: str
 
 
+class QueuedDownloadModel(QueueModel):
+    attempts: int
+    next_attempt_at: int
+    last_error: str | None
+    failed: bool  # permanently, it isn't retried anymore
+
+
 class ThreadModel(TypedDict):
     id: int  # tid, usually 1st answer
     uid: str
@@ -67,6 +82,44 @@ class SchemaVersion(TypedDict):
     version: int
 
 
+class CheckpointModel(TypedDict):
+    uid: str  # primary, one unfinished crawl per user
+    mode: str  # full, update
+    windows: str  # JSON list of [cursor, lower], crawled from cursor down to lower
+    batch: int  # batches committed so far
+    answers: int  # answers committed so far
+    started_at: int
+    updated_at: int
+
+
+class ProfileStats(TypedDict):
+    answers: int
+    oldest: int | None  # created_at of the oldest stored answer
+    newest: int | None
+
+
+class ChatStateModel(TypedDict):
+    qid: int  # primary
+    last_message_id: int | None  # None while the chat has no messages
+    last_message_at: int | None
+    message_count: int
+    has_older: bool  # older messages exist that weren't fetched
+    checked_at: int
+
+
+class WatchScheduleModel(TypedDict):
+    uid: str
+    next_check_at: int
+    last_check_at: int | None
+    interval: int  # seconds between the last check and the next one
+
+
+class CoverageModel(TypedDict):
+    uid: str
+    from_ts: int  # inclusive, every stream item between from_ts and to_ts is stored
+    to_ts: int  # inclusive
+
+
 class QuestionAnswerView(TypedDict):
     tid: int
     qid: int
@@ -85,8 +138,12 @@ class Database:
     def __init__(self, db_file):
         self.db = None
         self.db_file = db_file
+        self._transactions = 0
         if not os.path.exists(self.db_file):
             self.create_inital()
+        if self.db_file not in _migrated:
+            self.migrate()
+            _migrated.add(self.db_file)
 
     def create_inital(self):
         path = "./sqlite/migrations/1_inital_setup.sql"
@@ -101,6 +158,56 @@ class Database:
         db.commit()
         db.close()
 
+    def _migrations(self) -> list[tuple[int, str]]:
+        migrations = []
+        for name in os.listdir(MIGRATIONS_DIRECTORY):
+            match = re.match(r"(\d+)_.*\.sql$", name)
+            if match is not None:
+                migrations.append(
+                    (int(match.group(1)), os.path.join(MIGRATIONS_DIRECTORY, name))
+                )
+        return sorted(migrations)
+
+    def _schema_version(self, db: sqlite3.Connection) -> int:
+        # the initial setup doesn't record its version
+        version = db.execute("SELECT MAX(version) FROM schema").fetchone()[0]
+        return version or 1
+
+    def migrate(self):
+        """Applies the migrations newer than the version in the `schema` table."""
+        db = sqlite3.connect(
+            self.db_file, timeout=config.db_timeout, isolation_level=None
+        )
+        try:
+            migrations = self._migrations()
+            if migrations[-1][0] <= self._schema_version(db):
+                return
+
+            # check again under the write lock, another process may be migrating
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                version = self._schema_version(db)
+                for number, path in migrations:
+                    if number <= version:
+                        continue
+                    logging.info(f"migrating database to version {number}")
+                    with open(path, "r") as sql_file:
+                        script = sql_file.read()
+                    # executescript() would commit, so run the statements one by one
+                    statement = ""
+                    for line in script.splitlines(keepends=True):
+                        statement += line
+                        if sqlite3.complete_statement(statement):
+                            db.execute(statement)
+                            statement = ""
+                    db.execute("INSERT INTO schema (version) VALUES (?)", (number,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
     def _dict_factory(self, cursor, row):
         fields = [column[0] for column in cursor.description]
         return {key: value for key, value in zip(fields, row)}
@@ -108,8 +215,11 @@ class Database:
     def connect(self):
         if self.db is not None:
             self.close()
-        self.db = sqlite3.connect(self.db_file)
+        # several archiver processes may write at the same time: wait for the
+        # lock instead of failing, and let readers proceed while one writes
+        self.db = sqlite3.connect(self.db_file, timeout=config.db_timeout)
         self.db.row_factory = self._dict_factory
+        self.db.execute("PRAGMA journal_mode=WAL")
 
     def close(self):
         if self.db is None:
@@ -121,6 +231,26 @@ class Database:
     def ready(self) -> bool:
         return self.db is not None
 
+    def _commit(self):
+        if self._transactions == 0:
+            self.db.commit()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commits every write made inside the block at once, or none of them."""
+        if not self.ready():
+            raise Exception("database not ready")
+        self._transactions += 1
+        try:
+            yield self
+        except BaseException:
+            self._transactions -= 1
+            if self._transactions == 0:
+                self.db.rollback()
+            raise
+        self._transactions -= 1
+        self._commit()
+
     def insert(self, table: str, obj: dict):
         if not self.ready():
             raise Exception("database not ready")
@@ -135,11 +265,11 @@ class Database:
         try:
             cursor = self.db.cursor()
             cursor.execute(sql, list(obj.values()))
-            self.db.commit()
+            self._commit()
         except sqlite3.Error as e:
             logging.error(f"sqlite3 exception: {e}")
 
-    def insertmany(self, table: str, keys, values: list[tuple]):
+    def insertmany(self, table: str, keys, values: list[tuple], replace: bool = False):
         if not self.ready():
             raise Exception("database not ready")
         if len(values) == 0:
@@ -147,7 +277,8 @@ class Database:
 
         placeholders = ",".join(["?"] * len(keys))
         columns = ", ".join(keys)
-        sql = "INSERT OR IGNORE INTO %s ( %s ) VALUES ( %s )" % (
+        sql = "INSERT OR %s INTO %s ( %s ) VALUES ( %s )" % (
+            "REPLACE" if replace else "IGNORE",
             table,
             columns,
             placeholders,
@@ -155,7 +286,7 @@ class Database:
         try:
             cursor = self.db.cursor()
             cursor.executemany(sql, values)
-            self.db.commit()
+            self._commit()
         except sqlite3.Error as e:
             logging.error(f"sqlite3 exception: {e}")
 
@@ -167,7 +298,7 @@ class Database:
         try:
             cursor = self.db.cursor()
             cursor.execute(sql, (blob, id))
-            self.db.commit()
+            self._commit()
         except sqlite3.Error as e:
             logging.error(f"sqlite3 exception update_user_blob: {e}")
 
@@ -187,7 +318,7 @@ class Database:
         try:
             cursor = self.db.cursor()
             cursor.executemany(sql, values)
-            self.db.commit()
+            self._commit()
         except sqlite3.Error as e:
             logging.error(f"sqlite3 exception upsert_answers: {e}")
 
@@ -206,9 +337,30 @@ class Database:
         chat["uid"] = chat["uid"].lower()
         self.insert(table, chat)
 
-    def add_questions(self, keys, values: list[tuple[QuestionModel]]):
+    def add_chats(self, chats: list[ChatModel], replace: bool = False):
+        if len(chats) == 0:
+            return
+        for chat in chats:
+            if chat["author_id"] is not None:
+                chat["author_id"] = chat["author_id"].lower()
+            chat["uid"] = chat["uid"].lower()
+        self.insertmany(
+            "chats",
+            chats[0].keys(),
+            [tuple(chat.values()) for chat in chats],
+            replace=replace,
+        )
+
+    def add_questions(
+        self, keys, values: list[tuple[QuestionModel]], replace: bool = False
+    ):
         table = "questions"
-        self.insertmany(table, keys, values)
+        self.insertmany(table, keys, values, replace=replace)
+
+    def replace_answers(self, keys, values: list[tuple[AnswerModel]]):
+        """Writes @values over the answers that are stored already"""
+        table = "answers"
+        self.insertmany(table, keys, values, replace=True)
 
     def add_threads(self, keys, values: list[tuple[ThreadModel]]):
         table = "threads"
@@ -222,6 +374,221 @@ class Database:
         table = "download_queue"
         self.insert(table, visual)
 
+    def claim_downloads(
+        self, now: int, limit: int, lease: int, uids: list[str] | None = None
+    ) -> list[QueuedDownloadModel]:
+        """
+        Up to @limit queued downloads that are due, of @uids only if given. They
+        aren't due again for @lease seconds, so that concurrent drainers don't
+        claim the same ones.
+        """
+        if not self.ready():
+            raise Exception("database not ready")
+        sql = "SELECT * FROM download_queue WHERE failed = 0 AND next_attempt_at <= ?"
+        args: list = [now]
+        if uids:
+            sql += " AND (%s)" % " OR ".join(["directory LIKE ?"] * len(uids))
+            args += [f"./{uid.lower()}/%" for uid in uids]
+        sql += " ORDER BY next_attempt_at LIMIT ?"
+        args.append(limit)
+
+        if self.db.in_transaction:
+            self.db.commit()
+        # take the write lock before reading, so the claim is atomic
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            records = self.db.execute(sql, args).fetchall()
+            self.db.executemany(
+                "UPDATE download_queue SET next_attempt_at = ? WHERE id = ?",
+                [(now + lease, record["id"]) for record in records],
+            )
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        return records
+
+    def complete_download(self, queued: QueuedDownloadModel, visual: VisualModel):
+        """Moves @queued to the visuals and points its question or answer to it."""
+        with self.transaction():
+            self.add_visual(visual)
+            for table in ["questions", "answers"]:
+                self.db.execute(
+                    f"UPDATE {table} SET visual_id = ? WHERE visual_id = ?",
+                    (visual["id"], queued["id"]),
+                )
+            self.db.execute("DELETE FROM download_queue WHERE id = ?", (queued["id"],))
+
+    def retry_download(self, queued: QueuedDownloadModel):
+        """Stores the attempts, next attempt and error of @queued."""
+        self.db.execute(
+            """
+UPDATE download_queue
+SET attempts = ?, next_attempt_at = ?, last_error = ?, failed = ?
+WHERE id = ?
+            """,
+            (
+                queued["attempts"],
+                queued["next_attempt_at"],
+                queued["last_error"],
+                queued["failed"],
+                queued["id"],
+            ),
+        )
+        self._commit()
+
+    def get_checkpoint(self, uid: str) -> CheckpointModel | None:
+        sql = "SELECT * FROM crawl_checkpoints WHERE uid = ?"
+        records = self.fetch_all(sql, (uid.lower(),))
+        if not records:
+            return None
+        return records[0]
+
+    def save_checkpoint(self, checkpoint: CheckpointModel):
+        if not self.ready():
+            raise Exception("database not ready")
+
+        placeholders = ",".join(["?"] * len(checkpoint))
+        columns = ", ".join(checkpoint.keys())
+        sql = "INSERT OR REPLACE INTO crawl_checkpoints ( %s ) VALUES ( %s )" % (
+            columns,
+            placeholders,
+        )
+        # not caught: a checkpoint that isn't stored must fail the whole batch
+        self.db.execute(sql, list(checkpoint.values()))
+        self._commit()
+
+    def delete_checkpoint(self, uid: str):
+        if not self.ready():
+            raise Exception("database not ready")
+        self.db.execute("DELETE FROM crawl_checkpoints WHERE uid = ?", (uid.lower(),))
+        self._commit()
+
+    def get_chat_states(self, qids: list[int]) -> dict[int, ChatStateModel]:
+        states = {}
+        # stay below sqlite's limit of bound parameters
+        for i in range(0, len(qids), 500):
+            chunk = qids[i : i + 500]
+            sql = "SELECT * FROM chat_state WHERE qid IN ( %s )" % ",".join(
+                ["?"] * len(chunk)
+            )
+            for record in self.fetch_all(sql, chunk):
+                states[record["qid"]] = record
+        return states
+
+    def get_fetched_chat_states(self, uid: str) -> dict[int, ChatStateModel]:
+        """States of the chats of @uid that had messages when they were fetched"""
+        sql = """
+SELECT s.*
+FROM
+    chat_state s,
+    answers a
+WHERE
+    s.qid = a.qid AND
+    a.uid = ? AND
+    s.last_message_id IS NOT NULL;
+        """
+        records = self.fetch_all(sql, (uid.lower(),))
+        return {record["qid"]: record for record in records}
+
+    def save_chat_states(self, states: list[ChatStateModel]):
+        if len(states) == 0:
+            return
+        self.insertmany(
+            "chat_state",
+            states[0].keys(),
+            [tuple(state.values()) for state in states],
+            replace=True,
+        )
+
+    def get_due_chats(
+        self, uid: str, now: int, min_interval: int, limit: int
+    ) -> list[ChatStateModel]:
+        """
+        Chats that were quiet for less time before their last check than has passed
+        since, so the recently active ones come up often and old ones rarely.
+        Chats that had no messages count as quiet since their answer was posted.
+        """
+        sql = """
+SELECT s.*
+FROM
+    chat_state s,
+    answers a
+WHERE
+    s.qid = a.qid AND
+    a.uid = ? AND
+    ? - s.checked_at >= MAX(s.checked_at - COALESCE(s.last_message_at, a.created_at), ?)
+ORDER BY COALESCE(s.last_message_at, a.created_at) DESC
+LIMIT ?;
+        """
+        return self.fetch_all(sql, (uid.lower(), now, min_interval, limit))
+
+    def get_unchecked_chats(self, uid: str, limit: int) -> list[int]:
+        """qids among the newest @limit answers whose chat was never fetched"""
+        sql = """
+SELECT a.qid
+FROM
+    (SELECT qid, created_at FROM answers WHERE uid = ? ORDER BY created_at DESC LIMIT ?) a
+    LEFT JOIN chat_state s ON s.qid = a.qid
+WHERE s.qid IS NULL
+ORDER BY a.created_at DESC;
+        """
+        records = self.fetch_all(sql, (uid.lower(), limit))
+        return [record["qid"] for record in records]
+
+    def get_watch_schedule(self) -> dict[str, WatchScheduleModel]:
+        records = self.fetch_all("SELECT * FROM watch_schedule", ())
+        return {record["uid"]: record for record in records}
+
+    def save_watch_schedule(self, schedule: WatchScheduleModel):
+        if not self.ready():
+            raise Exception("database not ready")
+
+        placeholders = ",".join(["?"] * len(schedule))
+        columns = ", ".join(schedule.keys())
+        sql = "INSERT OR REPLACE INTO watch_schedule ( %s ) VALUES ( %s )" % (
+            columns,
+            placeholders,
+        )
+        try:
+            self.db.execute(sql, list(schedule.values()))
+            self._commit()
+        except sqlite3.Error as e:
+            logging.error(f"sqlite3 exception save_watch_schedule: {e}")
+
+    def get_recent_answer_times(self, uid: str, limit: int = 20) -> list[int]:
+        """created_at of the newest @limit answers, newest first"""
+        sql = "select created_at from answers where uid = ? order by created_at DESC limit ?"
+        records = self.fetch_all(sql, (uid.lower(), limit))
+        return [record["created_at"] for record in records]
+
+    def get_coverage(self, uid: str) -> list[CoverageModel]:
+        sql = "SELECT * FROM coverage WHERE uid = ? ORDER BY from_ts ASC"
+        return self.fetch_all(sql, (uid.lower(),))
+
+    def add_coverage(self, uid: str, from_ts: int, to_ts: int):
+        """Marks [@from_ts, @to_ts] as fetched, merged with the overlapping or adjacent intervals."""
+        if not self.ready():
+            raise Exception("database not ready")
+        if from_ts > to_ts:
+            return
+
+        uid = uid.lower()
+        sql = "SELECT * FROM coverage WHERE uid = ? AND from_ts <= ? AND to_ts >= ?"
+        cursor = self.db.execute(sql, (uid, to_ts + 1, from_ts - 1))
+        for record in cursor.fetchall():
+            from_ts = min(from_ts, record["from_ts"])
+            to_ts = max(to_ts, record["to_ts"])
+        self.db.execute(
+            "DELETE FROM coverage WHERE uid = ? AND from_ts <= ? AND to_ts >= ?",
+            (uid, to_ts + 1, from_ts - 1),
+        )
+        self.db.execute(
+            "INSERT INTO coverage (uid, from_ts, to_ts) VALUES (?, ?, ?)",
+            (uid, from_ts, to_ts),
+        )
+        self._commit()
+
     def fetch_all(self, sql: str, args):
         if not self.ready():
             raise Exception("database not ready")
@@ -317,6 +684,25 @@ ORDER BY
         records = self.fetch_all(sql, (uid.lower(),))
         return records[0]
 
+    def find_user(self, uid: str) -> UserModel | None:
+        sql = "Select * FROM users where id = ?"
+        records = self.fetch_all(sql, (uid.lower(),))
+        if not records:
+            return None
+        return records[0]
+
+    def get_profile_stats(self, uid: str) -> ProfileStats:
+        sql = """
+SELECT
+    COUNT(*) AS answers,
+    MIN(created_at) AS oldest,
+    MAX(created_at) AS newest
+FROM answers
+WHERE uid = ?
+        """
+        records = self.fetch_all(sql, (uid.lower(),))
+        return records[0]
+
     def get_answer_count(self, uid: str) -> int:
         sql = "select count(*) as count from answers where uid = ?"
         records = self.fetch_all(sql, (uid.lower(),))
@@ -337,6 +723,56 @@ ORDER BY
         records = self.fetch_all(sql, (uid.lower(),))
         return records[0]["created_at"]
 
+    def get_answer_likes(self, uid: str) -> Iterator[tuple[int, int]]:
+        """(qid, like_count) of every answer of @uid, sorted by qid"""
+        if not self.ready():
+            raise Exception("database not ready")
+        cursor = self.db.cursor()
+        # plain tuples, a dict per row adds up on large profiles
+        cursor.row_factory = None
+        cursor.execute(
+            "SELECT qid, like_count FROM answers WHERE uid = ? ORDER BY qid",
+            (uid.lower(),),
+        )
+        return iter(cursor)
+
+    def set_visual_blobs(self, blobs: list[tuple[str, str]]):
+        """@blobs (blob, directory) of visuals moved to the content store"""
+        if len(blobs) == 0:
+            return
+        try:
+            self.db.executemany(
+                "UPDATE visuals SET blob = ? WHERE directory = ?", blobs
+            )
+            self._commit()
+        except sqlite3.Error as e:
+            logging.error(f"sqlite3 exception set_visual_blobs: {e}")
+
+    def clear_visual_blobs(self, blobs: list[str]):
+        """Forgets the @blobs removed from the content store."""
+        if len(blobs) == 0:
+            return
+        try:
+            self.db.executemany(
+                "UPDATE visuals SET blob = NULL WHERE blob = ?",
+                [(blob,) for blob in blobs],
+            )
+            self._commit()
+        except sqlite3.Error as e:
+            logging.error(f"sqlite3 exception clear_visual_blobs: {e}")
+
+    def update_like_counts(self, likes: list[tuple[int, int]]):
+        """@likes (like_count, qid) of answers that are already stored"""
+        if len(likes) == 0:
+            return
+        try:
+            self.db.executemany(
+                "UPDATE answers SET like_count = ? WHERE qid = ?", likes
+            )
+            self._commit()
+        except sqlite3.Error as e:
+            logging.error(f"sqlite3 exception update_like_counts: {e}")
+
     def get_top_n_answers(self, uid: str, limit: int = 500) -> list[QuestionModel]:
         sql = "select qid from answers where uid = ? order by created_at DESC limit ?"
         records = self.fetch_all(sql, (uid.lower(), limit))
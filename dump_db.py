@@ -34,6 +34,7 @@ class DumpDatabase(Database):
         self.uid = uid.lower()
         self.db_file = os.path.join(config.output_directory, f"{uid}.db")
         self.db = None
+        self._transactions = 0
 
         if not os.path.exists(self.db_file):
             self.create_inital()
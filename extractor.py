@@ -6,265 +6,858 @@
 #
 import argparse
 import base64
+import contextlib
+import functools
+import json
 import logging
+import multiprocessing
 import os
-from datetime import datetime
-from typing import Tuple
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from typing import Tuple, TypedDict
 
 import config
-from askfm_api import AskfmApi, AskfmApiError
+from askfm_api import (
+    AskfmApi,
+    AskfmApiError,
+    AskfmApiPool,
+    RateLimiter,
+    SessionCache,
+    SqliteBucketStore,
+    Transport,
+)
 from askfm_api import requests as r
 from askfm_model import AskFM, askFMChat, askFMProfileDetails
-from database import Database
+from chat_fetcher import ChatFetcher, empty_chat
+from crawler import (
+    ASKFM_LAUNCH_TS,
+    KnownAnswers,
+    coverage_gaps,
+    sharded_profile_stream,
+    time_windows,
+)
+from database import ChatStateModel, CheckpointModel, Database, ProfileStats
+from pipeline import IngestPipeline
 from processor import Processor
+from progress import Progress
+from raw_archive import RawArchive
+from watcher import Watcher
 
 OUTPUT_DIRECTORY = config.output_directory
+# answers committed per checkpoint, below the pipeline's batch size
+CHECKPOINT_INTERVAL = 500
 
 logger = logging.getLogger(__name__)
-processor = Processor()
-
-logging.getLogger("requests").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
-def _get_chat_messages(qid: int) -> askFMChat | None:
-    try:
-        chats = api.request(r.fetch_chats(qid=qid))
-    except AskfmApiError as e:
-        if str(e) != "data_not_found":
-            logger.error(f"error when retrieveing chat for qid={qid}: {e}")
-        return None
-    else:
-        return chats
-
+def _new_rate_limiter(share: float = 1.0) -> RateLimiter:
+    """@share fraction of the configured limits given to this process"""
+    store = None
+    if config.rate_limit_db:
+        store = SqliteBucketStore(config.rate_limit_db)
+    return RateLimiter(
+        config.rate_limit * share,
+        max(int(config.rate_burst * share), 1),
+        limits={
+            path: (rate * share, max(int(burst * share), 1))
+            for path, (rate, burst) in config.rate_limits.items()
+        },
+        adaptive=config.rate_limit_adaptive,
+        store=store,
+    )
 
-def _get_profile_answer_count(username: str) -> int:
-    profile = api.request(r.fetch_profile(username))
-    answer_count = profile["answerCount"]
-    return answer_count
 
+rate_limiter = _new_rate_limiter()
+transport = Transport(
+    pool_maxsize=config.http_pool_size,
+    timeout=(config.http_connect_timeout, config.http_read_timeout),
+    compress=config.http_compress,
+)
+processor = Processor(rate_limiter=rate_limiter, transport=transport)
 
-def _get_stored_answered_count(username: str) -> int:
-    db = Database(config.db_file)
-    db.connect()
-    count = db.get_answer_count(uid=username)
-    db.close()
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
 
-    return count
 
+class ProfilePlan(TypedDict):
+    username: str
+    profile: askFMProfileDetails
+    profile_changed: bool  # the details differ from the ones stored by the last run
+    stats: ProfileStats
+    checkpoint: CheckpointModel | None
+    coverage: list[tuple[int, int]]
+    chat_qids: list[int]  # answers whose chats are due for a refresh
+    chat_states: dict[int, ChatStateModel]  # of @chat_qids, if they were fetched before
+    remaining: int  # answers expected to be fetched
+    resume: bool  # finish an interrupted crawl
+    crawl: bool  # look for answers that aren't stored yet
+    # the oldest stored answer, if an unrecorded crawl stopped before reaching the
+    # first answer, the crawl continues below it
+    backfill: int | None
+    refresh_chats: bool
+    skip: bool  # nothing changed since the last run
+
+
+def _fetch_profile(username: str) -> askFMProfileDetails:
+    profile: askFMProfileDetails = api.request(r.fetch_profile(username))
+    # remove useless keys
+    uesless_keys = [
+        "avatarThumbUrl",
+        "backgroundThumbUrl",
+        "online",
+        "unregisteredAvailable",
+        "blocked",
+        "active",
+        "friend",
+        "allowAnonymousQuestion",
+        "allowAnswerSharing",
+        "allowSubscribing",
+        "showAds",
+        "verifiedAccount",
+        "emoodjiId",
+    ]
+    for key in uesless_keys:
+        if key in profile:
+            profile.pop(key)
+    return profile
 
-def _get_remaining_answer_count(username: str, force: bool) -> int:
-    answer_count = _get_profile_answer_count(username)
-    stored_count = _get_stored_answered_count(username)
-    if force:
-        return answer_count
-    return abs(answer_count - stored_count)
 
+def plan_profile(
+    username: str,
+    force: bool = False,
+    fill_gaps: bool = False,
+    profile: askFMProfileDetails | None = None,
+    chats_limit: int = config.chat_refresh_limit,
+) -> ProfilePlan:
+    """
+    Decides what has to be done for @username from one profile fetch, unless
+    @profile is given, and one database connection.
+    """
+    if profile is None:
+        profile = _fetch_profile(username)
 
-def _get_newest_answer_time_stamp(username: str) -> int:
     db = Database(config.db_file)
     db.connect()
-    timestamp = db.get_newest_answer_time_stamp(uid=username)
+    stats = db.get_profile_stats(uid=username)
+    checkpoint = db.get_checkpoint(uid=username)
+    coverage = [
+        (record["from_ts"], record["to_ts"]) for record in db.get_coverage(uid=username)
+    ]
+    user = db.find_user(uid=username)
+    chat_states = {}
+    chat_qids = []
+    if not force and stats["answers"] > 0:
+        now = int(time.time())
+        # answers archived before chats were tracked come first, they are checked once
+        chat_qids = db.get_unchecked_chats(uid=username, limit=chats_limit)
+        due = db.get_due_chats(
+            uid=username,
+            now=now,
+            min_interval=config.chat_refresh_min_interval,
+            limit=chats_limit - len(chat_qids),
+        )
+        chat_states = {state["qid"]: state for state in due}
+        chat_qids += list(chat_states)
     db.close()
 
-    if timestamp is None:
-        return -1
-    return timestamp
+    previous = json.loads(user["blob"]) if user is not None and user["blob"] else None
+    profile_changed = profile != previous
+    answer_count = profile["answerCount"]
+    crawl = (
+        force
+        or fill_gaps
+        or stats["answers"] == 0
+        or previous is None
+        or answer_count != previous.get("answerCount")
+    )
+    refresh_chats = len(chat_qids) > 0
+    resume = checkpoint is not None
+    if checkpoint is not None and checkpoint["mode"] == "full":
+        remaining = answer_count - checkpoint["answers"]
+    elif force or stats["answers"] == 0:
+        remaining = answer_count
+    else:
+        remaining = answer_count - stats["answers"]
+    remaining = max(remaining, 0)
+    # archives made before checkpoints and coverage existed don't say where an
+    # interrupted crawl stopped, but the answers were stored newest first
+    backfill = None
+    if (
+        not force
+        and not fill_gaps
+        and checkpoint is None
+        and not coverage
+        and 0 < stats["answers"] < answer_count
+    ):
+        backfill = stats["oldest"]
+
+    return ProfilePlan(
+        username=username,
+        profile=profile,
+        profile_changed=profile_changed,
+        stats=stats,
+        checkpoint=checkpoint,
+        coverage=coverage,
+        chat_qids=chat_qids,
+        chat_states=chat_states,
+        remaining=remaining,
+        resume=resume,
+        crawl=crawl,
+        backfill=backfill,
+        refresh_chats=refresh_chats,
+        skip=not (resume or crawl or backfill or profile_changed or refresh_chats),
+    )
+
 
+def _window_of(windows: list[list], ts: int) -> list:
+    for window in windows:
+        if ts >= window[1]:
+            return window
+    return windows[-1]
 
-def _get_oldest_answer_time_stamp(username: str) -> int:
+
+def _load_known_answers(username: str) -> KnownAnswers:
     db = Database(config.db_file)
     db.connect()
-    timestamp = db.get_oldest_answer_time_stamp(uid=username)
+    chat_states = db.get_fetched_chat_states(uid=username)
+    known = KnownAnswers(db.get_answer_likes(uid=username), chat_states)
     db.close()
-
-    if timestamp is None:
-        return datetime.now().timestamp()
-    return timestamp
-
-
-def extract_answers_and_chats(username: str, force: bool = False, offset=None):
+    return known
+
+
+def _commit_batch(
+    pipeline: IngestPipeline,
+    chat_futures: list[Future],
+    likes: list[tuple[int, int]],
+    checkpoint: CheckpointModel,
+    windows: list[list],
+    tops: list[int],
+    answers_count: int,
+) -> CheckpointModel:
+    """
+    Ends the pipeline's batch, the answers put so far are committed with their chats
+    and the changed @likes, and the part of each window that has been crawled is
+    marked as covered.
+    """
+    pipeline.put_chats(chat_fetcher.collect(chat_futures))
+    chat_futures.clear()
+    if likes:
+        pipeline.update_likes(list(likes))
+        likes.clear()
+    checkpoint = CheckpointModel(
+        checkpoint,
+        windows=json.dumps(windows),
+        batch=checkpoint["batch"] + 1,
+        answers=checkpoint["answers"] + answers_count,
+        updated_at=int(time.time()),
+    )
+    coverage = [
+        (window[0], top) for window, top in zip(windows, tops) if window[0] is not None
+    ]
+    pipeline.checkpoint(checkpoint["uid"], checkpoint, coverage)
+    return checkpoint
+
+
+def extract_answers_and_chats(
+    username: str,
+    force: bool = False,
+    offset=None,
+    shards: int = 1,
+    fill_gaps: bool = False,
+    plan: ProfilePlan | None = None,
+):
     """
     @username is the username
     @force if true, then extraction will continue until the last answer is reached, otherwise it will
         stop when it reaches the last answer stored in the database.
     @offset the unix timestamp from which extraction begins. If None then starts from the beginning
+    @shards number of time windows crawled concurrently. Only used for full crawls, i.e. when
+        @force is true or nothing is stored for the user yet, since items arrive out of order.
+    @fill_gaps if true, then only the parts of the timeline that were never fully crawled are
+        fetched, @shards of them at a time. @force and @offset are ignored.
+    @plan of @username, made by `plan_profile` if None
+
+    The crawl is checkpointed with every committed batch. If @username has the checkpoint
+    of an interrupted crawl, that crawl is resumed instead and the arguments are ignored.
     """
-    if offset is not None:
-        logger.debug(f"extracting answers and chats from offset: {offset}")
+    chat_futures: list[Future] = []
+
+    if plan is None:
+        plan = plan_profile(username, force, fill_gaps)
+    remaining = plan["remaining"]
+    checkpoint = plan["checkpoint"]
+    if checkpoint is not None:
+        logger.info(
+            f"resuming the {checkpoint['mode']} crawl of {username} after"
+            f" {checkpoint['answers']} answers"
+        )
+        windows = json.loads(checkpoint["windows"])
     else:
-        logger.debug("extracting answers and chats")
-    profile_stream = api.request_iter(
-        r.fetch_profile_stream(username=username, skip="answer_chats", from_ts=offset)
-    )
-    answers: list[AskFM] = []
-    chats: list[askFMChat] = []
-    i = 0
+        if offset is not None:
+            logger.debug(f"extracting answers and chats from offset: {offset}")
+        else:
+            logger.debug("extracting answers and chats")
+        now = int(time.time())
+        newest_answer_timestamp = plan["stats"]["newest"]
+        if newest_answer_timestamp is None:
+            newest_answer_timestamp = -1
+        if fill_gaps:
+            mode = "fill"
+            windows = [
+                list(gap)
+                for gap in coverage_gaps(plan["coverage"], ASKFM_LAUNCH_TS, now)
+            ]
+            logger.info(f"{len(windows)} gaps in the archived timeline of {username}")
+            if not windows:
+                return 0, 0
+        # an offset means that the process was interrupted
+        elif force or offset is not None or newest_answer_timestamp == -1:
+            mode = "full"
+            windows = [[offset, ASKFM_LAUNCH_TS]]
+            if shards > 1:
+                upper = int(offset if offset is not None else time.time())
+                windows = [
+                    list(window)
+                    for window in time_windows(ASKFM_LAUNCH_TS, upper, shards)
+                ]
+        else:
+            mode = "update"
+            # stop before the newest stored answer
+            windows = [[None, newest_answer_timestamp + 1]]
+        checkpoint = CheckpointModel(
+            uid=username,
+            mode=mode,
+            windows=json.dumps(windows),
+            batch=0,
+            answers=0,
+            started_at=now,
+            updated_at=now,
+        )
+
+    # full and fill crawls go over answers that may already be stored, those only
+    # get their like count updated
+    known = None
+    if checkpoint["mode"] != "update" and plan["stats"]["answers"] > 0:
+        known = _load_known_answers(username)
+        logger.debug(f"{len(known)} answers of {username} are already stored")
+    likes: list[tuple[int, int]] = []
+    known_count = 0
+
+    # the newest timestamp of each window that's left to crawl, the windows' upper
+    # bounds are exclusive while coverage is inclusive
+    tops = [
+        window[0] - 1 if window[0] is not None else checkpoint["started_at"]
+        for window in windows
+    ]
 
-    remaining = _get_remaining_answer_count(username, force)
-    newest_answer_timestamp = _get_newest_answer_time_stamp(username)
-    if offset is not None:
-        # reset since it means the process was interrupted
-        newest_answer_timestamp = -1
+    if len(windows) > 1:
+        logger.debug(f"crawling the profile stream with {len(windows)} shards")
+        profile_stream = sharded_profile_stream(
+            api_pool,
+            username,
+            max(shards, 1),
+            prefetch=config.prefetch_pages,
+            windows=[tuple(window) for window in windows],
+        )
+    else:
+        profile_stream = api.request_iter(
+            r.fetch_profile_stream(
+                username=username, skip="answer_chats", from_ts=windows[0][0]
+            ),
+            prefetch=config.prefetch_pages,
+        )
 
     answers_count = 0
     chats_count = 0
+    batch_count = 0
     prev_answer: AskFM = None
     skipped_count = 0
-    while True:
-        answer: AskFM = next(profile_stream, None)
-        if answer is None:
-            break
-
-        if answer["type"] == "photopoll":
-            skipped_count += 1
-            continue
-
-        if (
-            not force
-            and answer["data"]["answer"]["createdAt"] <= newest_answer_timestamp
-        ):
-            break
-
-        if answer["type"] == "answer_chat":
-            # technically shouldn't be possible since we are skipping `answer_chats`
-            # this won't impact the extraction of chats.
-            continue
-
-        if answer["type"] != "question":
-            logger.warning(
-                f'question id: {answer["data"]["qid"]} has an unusual answer type: {answer["type"]}'
-            )
-            continue
-
-        if (
-            prev_answer is not None
-            and prev_answer["data"]["qid"] == answer["data"]["qid"]
-        ):
-            continue
-
-        answers.append(answer)
-        answers_count += 1
-        if answer["data"].get("chat", None):
-            chat = _get_chat_messages(answer["data"]["qid"])
-            chats.append(chat)
-            chats_count += 1
-
-        if len(answers) % 1000 == 0:
-            processor.process(answers)
-            processor.process_chat(chats)
-            answers.clear()
-            chats.clear()
-
-        prev_answer = answer
-        i += 1
-        print(f"Progress: {i/remaining*100:.1f}% - extraction\033[K", end="\r")
-
-    processor.process(answers)
-    processor.process_chat(chats)
+    pipeline = IngestPipeline(
+        processor, batch_size=1000, queue_size=config.pipeline_queue_size
+    )
+    progress = Progress(
+        "extraction", total=remaining, transport=transport, queues=pipeline.queue_sizes
+    )
+    with pipeline, contextlib.closing(profile_stream), progress:
+        # stored right away, so that even a crawl killed before its first batch resumes
+        pipeline.checkpoint(username, checkpoint)
+        try:
+            while True:
+                answer: AskFM = next(profile_stream, None)
+                if answer is None:
+                    break
+
+                if answer["type"] == "photopoll":
+                    skipped_count += 1
+                    continue
+
+                ts = answer["data"]["answer"]["createdAt"]
+                window = _window_of(windows, ts)
+                if len(windows) == 1 and ts < window[1]:
+                    break
+
+                if answer["type"] == "answer_chat":
+                    # technically shouldn't be possible since we are skipping `answer_chats`
+                    # this won't impact the extraction of chats.
+                    continue
+
+                if answer["type"] != "question":
+                    logger.warning(
+                        f'question id: {answer["data"]["qid"]} has an unusual answer type: {answer["type"]}'
+                    )
+                    continue
+
+                if (
+                    prev_answer is not None
+                    and prev_answer["data"]["qid"] == answer["data"]["qid"]
+                ):
+                    continue
+
+                qid = answer["data"]["qid"]
+                like_count = known.like_count(qid) if known is not None else None
+                if like_count is None:
+                    pipeline.put(answer)
+                else:
+                    known_count += 1
+                    new_like_count = answer["data"]["answer"].get("likeCount", 0)
+                    if new_like_count != like_count:
+                        likes.append((new_like_count, qid))
+                # everything newer than ts has been put, resume from ts itself
+                if window[0] is None or ts + 1 < window[0]:
+                    window[0] = ts + 1
+                answers_count += 1
+                batch_count += 1
+                if answer["data"].get("chat", None):
+                    state = None
+                    if like_count is not None:
+                        # stored already, only its new messages are fetched
+                        state = known.chat_state(qid)
+                    chat_futures.append(chat_fetcher.submit(qid, state))
+                    chats_count += 1
+                    progress.add("chats")
+                elif like_count is None:
+                    # so that the chat is only looked for once it's due
+                    pipeline.put_chats([empty_chat(qid)])
+
+                if batch_count == CHECKPOINT_INTERVAL:
+                    checkpoint = _commit_batch(
+                        pipeline,
+                        chat_futures,
+                        likes,
+                        checkpoint,
+                        windows,
+                        tops,
+                        batch_count,
+                    )
+                    batch_count = 0
+
+                prev_answer = answer
+                progress.add()
+
+        except BaseException:
+            # keep what was fetched, the next run resumes right after it
+            if pipeline.error is None and batch_count > 0:
+                _commit_batch(
+                    pipeline,
+                    chat_futures,
+                    likes,
+                    checkpoint,
+                    windows,
+                    tops,
+                    batch_count,
+                )
+            raise
+
+        # the crawl is complete, so its checkpoint goes with the last batch
+        pipeline.put_chats(chat_fetcher.collect(chat_futures))
+        if likes:
+            pipeline.update_likes(likes)
+        coverage = [(window[1], top) for window, top in zip(windows, tops)]
+        pipeline.checkpoint(username, None, coverage)
 
     logger.info(
         f"extracted {answers_count} answers and {chats_count} chats, skipped {skipped_count} photo polls"
     )
+    if known is not None:
+        logger.info(f"{known_count} answers were already archived")
 
-    return answers, chats
+    return answers_count, chats_count
 
 
-def extract_new_chats(username: str, limit: int = 700):
+def extract_new_chats(
+    username: str,
+    limit: int = 700,
+    qids: list[int] | None = None,
+    states: dict[int, ChatStateModel] | None = None,
+):
+    """
+    @qids of the answers to refresh, by default the newest @limit stored ones
+    @states of the chats that were fetched before, only their new messages are fetched
+    """
     logger.debug("extracting new chats for existing answers")
-    db = Database(config.db_file)
-    db.connect()
-    answer_ids = db.get_top_n_answers(uid=username, limit=limit)
-    db.close()
+    answer_ids = qids
+    if answer_ids is None:
+        db = Database(config.db_file)
+        db.connect()
+        answer_ids = db.get_top_n_answers(uid=username, limit=limit)
+        db.close()
 
     chats: list[askFMChat] = []
-    i = 0
-    for id in answer_ids:
-        chat = _get_chat_messages(qid=id)
-        if chat is not None:
-            chats.append(chat)
-        i += 1
-        print(f"Progress: {i/len(answer_ids)*100:.1f}% - new chats\033[K", end="\r")
+    with Progress("new chats", total=len(answer_ids), transport=transport) as progress:
+        for chat in chat_fetcher.map(answer_ids, states):
+            if chat is not None:
+                chats.append(chat)
+                progress.add("chats")
+            progress.add()
 
-    print()
     processor.process_chat(chats)
     logger.debug(f"number of new chats extracted: {len(chats)}")
 
 
-def extract_profile_info(username: str):
-    profile: askFMProfileDetails = api.request(r.fetch_profile(username))
-    # remove useless keys
-    uesless_keys = [
-        "avatarThumbUrl",
-        "backgroundThumbUrl",
-        "online",
-        "unregisteredAvailable",
-        "blocked",
-        "active",
-        "friend",
-        "allowAnonymousQuestion",
-        "allowAnswerSharing",
-        "allowSubscribing",
-        "showAds",
-        "verifiedAccount",
-        "emoodjiId",
-    ]
-    for key in uesless_keys:
-        if key in profile:
-            profile.pop(key)
+class ProfileResult(TypedDict):
+    username: str
+    ok: bool
+    skipped: bool
+    error: str | None
+    answers: int
+    chats: int
+    seconds: float
 
-    processor.process_profile(profile)
 
+def setup(api_key: str, shards: int = 1, session_cache_file: str | None = None):
+    """
+    Creates the API sessions used by the extraction functions.
+    @session_cache_file overrides config.session_cache_file, each process needs its own
+    """
+    global api, api_pool, chat_fetcher
+
+    if session_cache_file is None:
+        session_cache_file = config.session_cache_file
+    session_cache = None
+    if session_cache_file:
+        session_cache = SessionCache(session_cache_file)
+    raw_archive = None
+    if config.raw_archive_directory:
+        raw_archive = RawArchive()
+    api = AskfmApi(
+        api_key,
+        auth=(config.username, config.password),
+        host=config.api_host,
+        scheme=config.api_scheme,
+        rate_limiter=rate_limiter,
+        transport=transport,
+        session_cache=session_cache,
+        on_response=raw_archive,
+    )
+    api_pool = AskfmApiPool(
+        api_key,
+        size=config.chat_workers + max(shards, 1),
+        auth=(config.username, config.password),
+        host=config.api_host,
+        scheme=config.api_scheme,
+        rate_limiter=rate_limiter,
+        transport=transport,
+        session_cache=session_cache,
+        on_response=raw_archive,
+    )
+    chat_fetcher = ChatFetcher(api_pool, workers=config.chat_workers)
 
-def run(usernames: list[str], force: bool = False, offset=None):
+    if not api.logged_in:
+        try:
+            api.log_in(config.username, config.password)
+        except AskfmApiError as e:
+            logger.error(f"error logging-in: {e}")
+
+
+def teardown():
+    chat_fetcher.close()
+    processor.close()
+    if api.on_response is not None:
+        api.on_response.close()
+    api.save_session()
+    api_pool.save_sessions()
+    for host, stats in transport.stats().items():
+        logger.info(f"{host}: {stats['requests']} requests, {stats['bytes']} bytes")
+
+
+def archive_profile(
+    username: str,
+    force: bool = False,
+    offset=None,
+    shards: int = 1,
+    fill_gaps: bool = False,
+) -> ProfileResult:
+    username = username.lower()
+    result = ProfileResult(
+        username=username,
+        ok=False,
+        skipped=False,
+        error=None,
+        answers=0,
+        chats=0,
+        seconds=0.0,
+    )
+    started = time.monotonic()
     try:
-        api.log_in(config.username, config.password)
-    except AskfmApiError as e:
-        logger.error(f"error logging-in: {e}")
+        plan = plan_profile(username, force, fill_gaps)
+        if plan["skip"]:
+            logger.info(f"{username} didn't change since the last run, skipping")
+            result["ok"] = True
+            result["skipped"] = True
+            return result
+
+        os.makedirs(os.path.join(OUTPUT_DIRECTORY, username), exist_ok=True)
+        profile_changed = plan["profile_changed"]
+        if profile_changed:
+            processor.process_profile(plan["profile"])
+        if plan["refresh_chats"]:
+            extract_new_chats(
+                username=username, qids=plan["chat_qids"], states=plan["chat_states"]
+            )
+        checkpoint = plan["checkpoint"]
+        if plan["resume"]:
+            # finish the crawl that was interrupted first
+            answers, chats = extract_answers_and_chats(
+                username, shards=shards, plan=plan
+            )
+            result["answers"] += answers
+            result["chats"] += chats
+            if force and checkpoint["mode"] == "full":
+                # the forced crawl was the one resumed
+                force = False
+            plan = plan_profile(username, force, fill_gaps, profile=plan["profile"])
+            # what was answered since the interrupted crawl started is missing
+            plan["crawl"] = True
+        if plan["crawl"]:
+            answers, chats = extract_answers_and_chats(
+                username,
+                force,
+                offset=offset,
+                shards=shards,
+                fill_gaps=fill_gaps,
+                plan=plan,
+            )
+            result["answers"] += answers
+            result["chats"] += chats
+        if plan["backfill"] is not None and offset is None:
+            logger.info(f"continuing extracting from timestamp: {plan['backfill']}")
+            answers, chats = extract_answers_and_chats(
+                username, offset=plan["backfill"], shards=shards, plan=plan
+            )
+            result["answers"] += answers
+            result["chats"] += chats
+        if profile_changed:
+            # only now, a run that stops before crawls again next time
+            processor.save_profile(plan["profile"])
+        result["ok"] = True
 
+    except AskfmApiError as e:
+        logger.error(f"error: {e}")
+        result["error"] = str(e)
+    finally:
+        result["seconds"] = time.monotonic() - started
+    return result
+
+
+def run(
+    usernames: list[str],
+    force: bool = False,
+    offset=None,
+    shards: int = 1,
+    fill_gaps: bool = False,
+) -> list[ProfileResult]:
+    results = []
     i = 0
     for username in usernames:
         i += 1
         logger.info(f"starting job {i}/{len(usernames)} for {username}")
-        username = username.lower()
-        try:
-            os.makedirs(os.path.join(OUTPUT_DIRECTORY, username), exist_ok=True)
-            extract_profile_info(username)
-            if not force:
-                extract_new_chats(username=username, limit=100)
-            extract_answers_and_chats(username, force, offset=offset)
-            oldest_timestamp = _get_oldest_answer_time_stamp(username)
-            archived_count = _get_stored_answered_count(username)
-            remaining_count = _get_profile_answer_count(username)
-            if remaining_count > archived_count:
-                logger.info(f"continuing extracting from timestamp: {oldest_timestamp}")
-                extract_answers_and_chats(username, offset=oldest_timestamp)
+        results.append(
+            archive_profile(
+                username, force, offset=offset, shards=shards, fill_gaps=fill_gaps
+            )
+        )
+    return results
 
-        except AskfmApiError as e:
-            logger.error(f"error: {e}")
 
-        print()
+_interrupted = False
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        prog="askfm-archiver", description="archive ask.fm profiles"
-    )
-    parser.add_argument("usernames", nargs="+")
+def _init_worker(api_key: str, shards: int, jobs: int, slots):
+    """Runs once in every worker process of `run_parallel`."""
+    global rate_limiter
+
+    _setup_logging()
+    if not config.rate_limit_db:
+        # without a shared bucket store every process gets its share of the limit
+        rate_limiter = _new_rate_limiter(share=1 / jobs)
+        processor.rate_limiter = rate_limiter
+
+    # workers must not share the rolling session token, so each worker slot
+    # keeps its sessions in its own cache file
+    slot = slots.get()
+    session_cache_file = config.session_cache_file
+    if session_cache_file and slot > 0:
+        session_cache_file = f"{session_cache_file}.{slot}"
+    setup(api_key, shards, session_cache_file=session_cache_file)
 
-    args = parser.parse_args()
 
+def _archive_in_worker(
+    username: str, force: bool, offset, shards: int, fill_gaps: bool
+) -> ProfileResult:
+    global _interrupted
+
+    if _interrupted:
+        # Ctrl-C reached the worker while this profile was already queued for it
+        raise KeyboardInterrupt
+    logger.info(f"worker {os.getpid()} starting {username}")
+    try:
+        return archive_profile(
+            username, force, offset=offset, shards=shards, fill_gaps=fill_gaps
+        )
+    except KeyboardInterrupt:
+        _interrupted = True
+        raise
+    finally:
+        # there's no hook when the pool shuts its workers down, and a gzip
+        # segment that isn't closed has no end-of-stream marker
+        api.save_session()
+        api_pool.save_sessions()
+        if api.on_response is not None:
+            api.on_response.close()
+
+
+def run_parallel(
+    api_key: str,
+    usernames: list[str],
+    jobs: int,
+    force: bool = False,
+    offset=None,
+    shards: int = 1,
+    fill_gaps: bool = False,
+) -> list[ProfileResult]:
+    """
+    Archives @usernames on @jobs worker processes, one profile per worker at a time.
+    Each worker logs in with its own sessions, and writes its profiles' visuals to
+    their own output directories. A profile that fails doesn't stop the others.
+    """
+    jobs = min(jobs, len(usernames))
+    # spawn, so the workers don't inherit open connections from this process
+    ctx = multiprocessing.get_context("spawn")
+    slots = ctx.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+
+    results: dict[str, ProfileResult] = {}
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(api_key, shards, jobs, slots),
+    ) as executor:
+        futures = {
+            executor.submit(
+                _archive_in_worker, username, force, offset, shards, fill_gaps
+            ): username
+            for username in usernames
+        }
+        try:
+            for future in as_completed(futures):
+                username = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"worker failed archiving {username}: {e!r}")
+                    result = ProfileResult(
+                        username=username.lower(),
+                        ok=False,
+                        skipped=False,
+                        error=repr(e),
+                        answers=0,
+                        chats=0,
+                        seconds=0.0,
+                    )
+                results[username] = result
+                logger.info(
+                    f"finished {username}: {'ok' if result['ok'] else 'failed'}"
+                    f" ({len(results)}/{len(usernames)})"
+                )
+        except KeyboardInterrupt:
+            # the workers got the interrupt too and are stopping their profiles,
+            # don't let them start the ones left
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    return [results[username] for username in usernames]
+
+
+def _requests_made() -> int:
+    return sum(stats["requests"] for stats in transport.stats().values())
+
+
+def _log_summary(results: list[ProfileResult]):
+    failed = [result for result in results if not result["ok"]]
+    logger.info(f"archived {len(results) - len(failed)}/{len(results)} profiles")
+    for result in results:
+        status = "ok" if result["ok"] else f"failed: {result['error']}"
+        if result["skipped"]:
+            status = "unchanged"
+        logger.info(
+            f"  {result['username']}: {result['answers']} answers, {result['chats']} chats"
+            f" in {result['seconds']:.0f}s - {status}"
+        )
+
+
+def _setup_logging():
     logging.basicConfig(
         level=logging.INFO,
         format="time=%(asctime)s  origin=%(name)s level=%(levelname)s msg=%(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
         filename="extractor.log",
         filemode="a",
+        force=True,  # the database module may have configured logging on import
     )
 
     logging.getLogger().addHandler(logging.FileHandler("extractor.log"))
     logging.getLogger().addHandler(logging.StreamHandler())
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="askfm-archiver", description="archive ask.fm profiles"
+    )
+    parser.add_argument("usernames", nargs="+")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="crawl the whole profile instead of stopping at the newest stored answer",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=config.crawl_shards,
+        help="number of time windows crawled concurrently on full crawls",
+    )
+    parser.add_argument(
+        "--fill-gaps",
+        action="store_true",
+        help="only crawl the parts of the timeline that were never fully archived",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=config.jobs,
+        help="number of profiles archived in parallel, each in its own process",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and check every profile again as often as it tends to change",
+    )
+
+    args = parser.parse_args()
+
+    _setup_logging()
+
     if len(config.username) == 0 or len(config.password) == 0:
         print("askfm credentials are missing. Edit config.py with your credentials")
         exit(-1)
@@ -273,5 +866,43 @@ if __name__ == "__main__":
         print("API Key is missing from config.py. The key can be found in the README. ")
         exit(-1)
 
-    api = AskfmApi(base64.b64decode(config.key).decode("ascii"))
-    run(args.usernames)
+    api_key = base64.b64decode(config.key).decode("ascii")
+    if args.watch:
+        setup(api_key, args.shards)
+        watcher = Watcher(
+            args.usernames,
+            functools.partial(archive_profile, shards=args.shards),
+            requests_made=_requests_made,
+        )
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            logger.info("stopped watching")
+        finally:
+            teardown()
+        exit(0)
+
+    if args.jobs > 1 and len(args.usernames) > 1:
+        results = run_parallel(
+            api_key,
+            args.usernames,
+            args.jobs,
+            force=args.force,
+            shards=args.shards,
+            fill_gaps=args.fill_gaps,
+        )
+    else:
+        setup(api_key, args.shards)
+        try:
+            results = run(
+                args.usernames,
+                force=args.force,
+                shards=args.shards,
+                fill_gaps=args.fill_gaps,
+            )
+        finally:
+            teardown()
+
+    _log_summary(results)
+    if not all(result["ok"] for result in results):
+        exit(1)
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+from urllib.parse import urlsplit
+
+import config
+
+
+class MediaDownloader:
+    """
+    Downloads visuals on a pool of @workers threads, with at most @per_host
+    downloads from the same host at a time. `submit` returns right away, the
+    caller collects the result of @download from the future.
+    """
+
+    def __init__(
+        self,
+        download: Callable[[str, str], Any],
+        workers: int = config.media_workers,
+        per_host: int = config.media_per_host,
+    ):
+        """@download(url, path) saves the visual at url in the directory path"""
+        self.download = download
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host)
+
+        self._hosts: dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="media"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _host_slots(self, url: str) -> threading.Semaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def _download(self, url: str, path: str) -> Any:
+        with self._host_slots(url):
+            return self.download(url, path)
+
+    def submit(self, url: str, path: str) -> Future:
+        return self._executor.submit(self._download, url, path)
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,379 @@
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from typing import Iterator, TypedDict
+
+import config
+from database import Database
+from media_store import HASH_CHUNK_SIZE, file_digest
+
+PACK_MAGIC = b"AFMP"
+# magic, length of the path, length of the content, sha256 of the content,
+# followed by the path and the content
+PACK_HEADER = struct.Struct(">4sHQ32s")
+
+
+def visual_type(path: str) -> str:
+    """The type of the visual at @path, as in `visuals`, told by its extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".mp4":
+        return "video"
+    if ext == ".gif":
+        return "gif"
+    return "photo"
+
+
+class PackedVisualModel(TypedDict):
+    path: str  # <uid>/<file name>, relative to the output directory
+    pack: str  # file name of the pack
+    offset: int  # of the content in the pack
+    length: int
+    type: str  # gif, photo, video
+    sha256: str
+
+
+class PackRecord(TypedDict):
+    path: str
+    offset: int  # of the content in the pack
+    length: int
+    sha256: str  # as written in the header
+    valid: bool  # the content matches the sha256
+
+
+class PackStore:
+    """
+    Appends the visuals to large pack files instead of keeping one file per
+    visual:
+
+        <output directory>/.packs/pack-<opened at>-<pid>-<n>.pack
+
+    Each record is a header, the visual's path and its content. The
+    `packed_visuals` table indexes the records by path, so a visual is found
+    without reading the packs, and identical visuals are stored once. Every
+    process writes its own packs and starts a new one after @pack_size bytes.
+    Reads go through memory maps of the packs.
+    """
+
+    def __init__(
+        self,
+        directory: str = config.output_directory,
+        db_file: str = config.db_file,
+        pack_size: int = config.media_pack_size,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.output_directory = directory
+        self.directory = os.path.join(directory, ".packs")
+        self.pack_size = pack_size
+        os.makedirs(self.directory, exist_ok=True)
+
+        # applies the migrations, the index is one of them
+        Database(db_file)
+        self._db = sqlite3.connect(
+            db_file,
+            timeout=config.db_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.Lock()
+        self._pack = None
+        self._pack_name = ""
+        self._count = 0
+        self._maps: dict[str, mmap.mmap] = {}
+        # digest of the visuals added by this process, by path, until popped
+        self._digests: dict[str, str] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def key(self, path: str) -> str:
+        """The index key of the visual at @path, <uid>/<file name>."""
+        return os.path.relpath(path, self.output_directory).replace(os.sep, "/")
+
+    def exists(self, path: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM packed_visuals WHERE path = ?", (self.key(path),)
+            ).fetchone()
+        return row is not None
+
+    def add(self, file: str, path: str) -> tuple[str, bool]:
+        """
+        Appends @file to the current pack as the visual at @path and removes it.
+        Returns the digest of the content and whether it was stored already.
+        """
+        digest = file_digest(file)
+        length = os.path.getsize(file)
+        key = self.key(path)
+        type = visual_type(path)
+        with self._lock:
+            stored = self._db.execute(
+                "SELECT pack, offset FROM packed_visuals"
+                " WHERE sha256 = ? AND length = ?",
+                (digest, length),
+            ).fetchone()
+            if stored is not None:
+                pack, offset = stored
+            else:
+                pack, offset = self._append(file, key, digest, length)
+            self._db.execute(
+                "INSERT OR REPLACE INTO packed_visuals"
+                " (path, pack, offset, length, type, sha256)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, pack, offset, length, type, digest),
+            )
+            self._digests[key] = digest
+        os.remove(file)
+        return digest, stored is not None
+
+    def _append(self, file: str, key: str, digest: str, length: int) -> tuple[str, int]:
+        if self._pack is None or self._pack.tell() >= self.pack_size:
+            self._open_pack()
+        path = key.encode()
+        header = PACK_HEADER.pack(PACK_MAGIC, len(path), length, bytes.fromhex(digest))
+        start = self._pack.tell()
+        try:
+            self._pack.write(header)
+            self._pack.write(path)
+            offset = self._pack.tell()
+            with open(file, "rb") as source:
+                while chunk := source.read(HASH_CHUNK_SIZE):
+                    self._pack.write(chunk)
+            # on disk before the index points to it
+            self._pack.flush()
+            os.fsync(self._pack.fileno())
+        except BaseException:
+            # the next records must follow a whole one
+            self._pack.truncate(start)
+            raise
+        return self._pack_name, offset
+
+    def _open_pack(self):
+        if self._pack is not None:
+            self._pack.close()
+        self._count += 1
+        opened_at = time.strftime("%Y%m%d%H%M%S")
+        self._pack_name = f"pack-{opened_at}-{os.getpid()}-{self._count:04d}.pack"
+        self._pack = open(os.path.join(self.directory, self._pack_name), "ab")
+        self.logger.debug(f"writing visuals to {self._pack_name}")
+
+    def pop_digest(self, path: str) -> str | None:
+        """The digest of @path if it was added by this process, forgotten after."""
+        with self._lock:
+            return self._digests.pop(self.key(path), None)
+
+    def get(self, path: str) -> bytes | None:
+        """The content of the visual at @path, None if it isn't packed."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT pack, offset, length FROM packed_visuals WHERE path = ?",
+                (self.key(path),),
+            ).fetchone()
+            if row is None:
+                return None
+            pack, offset, length = row
+            data = self._map(pack, offset + length)
+            return data[offset : offset + length]
+
+    def _map(self, pack: str, size: int) -> mmap.mmap:
+        data = self._maps.get(pack)
+        if data is None or len(data) < size:
+            # the pack grew since it was mapped
+            if data is not None:
+                data.close()
+            with open(os.path.join(self.directory, pack), "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[pack] = data
+        return data
+
+    def visuals(self, uid: str | None = None) -> list[PackedVisualModel]:
+        """The packed visuals, of @uid only if given, in the order of the packs."""
+        sql = "SELECT path, pack, offset, length, type, sha256 FROM packed_visuals"
+        args = []
+        if uid is not None:
+            sql += " WHERE path LIKE ?"
+            args.append(f"{uid.lower()}/%")
+        sql += " ORDER BY pack, offset"
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [
+            PackedVisualModel(
+                path=path,
+                pack=pack,
+                offset=offset,
+                length=length,
+                type=type,
+                sha256=sha256,
+            )
+            for path, pack, offset, length, type, sha256 in rows
+        ]
+
+    def packs(self) -> list[str]:
+        return sorted(
+            name for name in os.listdir(self.directory) if name.endswith(".pack")
+        )
+
+    def records(self, pack: str) -> Iterator[PackRecord]:
+        """
+        Reads the records of @pack one after the other and checks their content.
+        Stops at a record that a crash left half written.
+        """
+        with open(os.path.join(self.directory, pack), "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        with data:
+            position = 0
+            while position + PACK_HEADER.size <= len(data):
+                magic, path_length, length, digest = PACK_HEADER.unpack_from(
+                    data, position
+                )
+                offset = position + PACK_HEADER.size + path_length
+                if magic != PACK_MAGIC or offset + length > len(data):
+                    self.logger.warning(f"{pack} ends with a truncated record")
+                    return
+                path = data[position + PACK_HEADER.size : offset].decode()
+                content = hashlib.sha256(data[offset : offset + length])
+                yield PackRecord(
+                    path=path,
+                    offset=offset,
+                    length=length,
+                    sha256=digest.hex(),
+                    valid=content.digest() == digest,
+                )
+                position = offset + length
+
+    def verify(self) -> list[str]:
+        """Reads every pack and returns the problems found with them or the index."""
+        problems = []
+        records = {}
+        for pack in self.packs():
+            for record in self.records(pack):
+                if not record["valid"]:
+                    problems.append(f"{record['path']}: corrupted in {pack}")
+                records[(pack, record["offset"])] = record
+        for visual in self.visuals():
+            record = records.get((visual["pack"], visual["offset"]))
+            if record is None or record["sha256"] != visual["sha256"]:
+                problems.append(f"{visual['path']}: not found in {visual['pack']}")
+        return problems
+
+    def import_directory(self, uid: str) -> tuple[list[tuple[str, str]], int]:
+        """
+        Moves the visuals of @uid that are files into the packs. Returns the
+        (digest, file name) of the visuals imported, and the bytes saved by
+        storing identical visuals once.
+        """
+        directory = os.path.join(self.output_directory, uid)
+        blobs = []
+        saved = 0
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            if not entry.is_file() or entry.name.endswith((".part", ".link")):
+                continue
+            size = entry.stat().st_size
+            digest, stored = self.add(entry.path, entry.path)
+            self.pop_digest(entry.path)
+            if stored:
+                saved += size
+            blobs.append((digest, entry.name))
+        return blobs, saved
+
+    def unpack(self, uid: str | None = None) -> int:
+        """
+        Writes the packed visuals, of @uid only if given, back as files. Returns
+        how many were written.
+        """
+        count = 0
+        for visual in self.visuals(uid):
+            path = os.path.join(self.output_directory, *visual["path"].split("/"))
+            if os.path.isfile(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = self.get(path)
+            with open(f"{path}.part", "wb") as file:
+                file.write(data)
+            os.replace(f"{path}.part", path)
+            count += 1
+        return count
+
+    def close(self):
+        with self._lock:
+            if self._pack is not None:
+                self._pack.close()
+                self._pack = None
+            for data in self._maps.values():
+                data.close()
+            self._maps.clear()
+            self._db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="askfm-pack",
+        description="manages the pack files of the visuals, see media_store in"
+        " config.py",
+    )
+    parser.add_argument(
+        "command",
+        choices=["import", "unpack", "list", "verify"],
+        help="import: moves the visuals that are files into the packs,"
+        " unpack: writes the packed visuals of the users back as files, e.g. to"
+        " view their html files, list: lists the packed visuals, verify: reads"
+        " every pack and checks the visuals and the index",
+    )
+    parser.add_argument("usernames", nargs="*", help="all users by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="time=%(asctime)s  origin=%(name)s level=%(levelname)s msg=%(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logger = logging.getLogger(__name__)
+
+    store = PackStore()
+    uids = [uid.lower() for uid in args.usernames]
+    if len(uids) == 0 and args.command == "import":
+        uids = [
+            entry.name
+            for entry in os.scandir(config.output_directory)
+            if entry.is_dir() and not entry.name.startswith(".")
+        ]
+
+    if args.command == "import":
+        db = Database(config.db_file)
+        db.connect()
+        for uid in uids:
+            blobs, saved = store.import_directory(uid)
+            db.set_visual_blobs(
+                [(digest, os.path.join("./", uid, name)) for digest, name in blobs]
+            )
+            logger.info(f"packed {len(blobs)} files of {uid}, {saved} bytes saved")
+        db.close()
+    elif args.command == "unpack":
+        for uid in uids or [None]:
+            logger.info(f"unpacked {store.unpack(uid)} files")
+    elif args.command == "list":
+        for visual in store.visuals():
+            if uids and visual["path"].split("/")[0] not in uids:
+                continue
+            print(
+                f"{visual['path']}\t{visual['type']}\t{visual['length']}"
+                f"\t{visual['sha256']}"
+                f"\t{visual['pack']}:{visual['offset']}"
+            )
+    else:
+        problems = store.verify()
+        for problem in problems:
+            logger.error(problem)
+        logger.info(f"{len(store.visuals())} visuals checked, {len(problems)} problems")
+    store.close()
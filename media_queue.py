@@ -0,0 +1,158 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import Future, as_completed
+
+import config
+from askfm_api import RateLimiter, SqliteBucketStore, Transport
+from database import Database, QueuedDownloadModel, VisualModel
+from media import MediaDownloader
+from processor import DownloadError, Processor
+
+
+def next_attempt_delay(attempts: int) -> int:
+    """Seconds before the next attempt of a download that failed @attempts times."""
+    delay = config.media_retry_delay * 2 ** (attempts - 1)
+    return int(min(delay, config.media_retry_max_delay))
+
+
+class DownloadQueueDrainer:
+    """
+    Retries the downloads of the `download_queue` table on a pool of media
+    workers. A download that succeeds is moved to `visuals`. One that fails is
+    retried with exponential backoff, until it fails `media_max_attempts` times
+    or with a permanent error such as a 404, which are kept but not retried.
+
+    Downloads are claimed for `media_claim_lease` seconds before they start, so
+    any number of drainers and extractors can run at the same time.
+    """
+
+    def __init__(
+        self,
+        processor: Processor,
+        uids: list[str] | None = None,
+        workers: int = config.media_workers,
+    ):
+        """
+        @processor downloads the visuals
+        @uids only drains the visuals of these users if given
+        """
+        self.logger = logging.getLogger(__name__)
+        self.downloader = MediaDownloader(processor.download_visual, workers=workers)
+        self.store = processor.store
+        self.uids = [uid.lower() for uid in uids or []]
+        self.db = Database(config.db_file)
+        self.batch_size = self.downloader.workers * 4
+        self.counts = {"downloaded": 0, "retried": 0, "failed": 0}
+
+    def drain(self) -> dict[str, int]:
+        """Works through the downloads that are due, returns what became of them."""
+        self.db.connect()
+        try:
+            while True:
+                claimed = self.db.claim_downloads(
+                    now=int(time.time()),
+                    limit=self.batch_size,
+                    lease=config.media_claim_lease,
+                    uids=self.uids,
+                )
+                if len(claimed) == 0:
+                    break
+                self._download(claimed)
+        finally:
+            self.db.close()
+            self.downloader.close()
+        return self.counts
+
+    def _download(self, claimed: list[QueuedDownloadModel]):
+        futures: dict[Future, QueuedDownloadModel] = {}
+        for queued in claimed:
+            path = os.path.join(config.output_directory, queued["directory"])
+            futures[self.downloader.submit(queued["url"], path)] = queued
+
+        for future in as_completed(futures):
+            queued = futures[future]
+            try:
+                visual_id = future.result()
+            except DownloadError as e:
+                self._failed(queued, e)
+                continue
+            directory = os.path.join(os.path.dirname(queued["directory"]), visual_id)
+            blob = None
+            if self.store is not None:
+                path = os.path.join(config.output_directory, directory)
+                blob = self.store.pop_digest(path)
+            visual = VisualModel(
+                id=visual_id, type=queued["type"], directory=directory, blob=blob
+            )
+            self.db.complete_download(queued, visual)
+            self.counts["downloaded"] += 1
+
+    def _failed(self, queued: QueuedDownloadModel, e: DownloadError):
+        queued["attempts"] += 1
+        queued["last_error"] = str(e)
+        delay = next_attempt_delay(queued["attempts"])
+        queued["next_attempt_at"] = int(time.time()) + delay
+        queued["failed"] = (
+            e.permanent or queued["attempts"] >= config.media_max_attempts
+        )
+        self.db.retry_download(queued)
+        if queued["failed"]:
+            self.logger.warning(
+                f"giving up on {queued['id']} after {queued['attempts']} attempts: {e}"
+            )
+            self.counts["failed"] += 1
+        else:
+            self.logger.info(f"download of {queued['id']} failed, will retry: {e}")
+            self.counts["retried"] += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="askfm-media",
+        description="downloads the visuals that failed to download while archiving",
+    )
+    parser.add_argument(
+        "usernames", nargs="*", help="only the visuals of these users, all by default"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.media_workers,
+        help=f"concurrent downloads, {config.media_workers} by default",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="time=%(asctime)s  origin=%(name)s level=%(levelname)s msg=%(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logger = logging.getLogger(__name__)
+
+    # media downloads share the extractor's budget when rate_limit_db is set
+    store = None
+    if config.rate_limit_db:
+        store = SqliteBucketStore(config.rate_limit_db)
+    rate_limiter = RateLimiter(
+        config.rate_limit,
+        config.rate_burst,
+        limits=config.rate_limits,
+        adaptive=config.rate_limit_adaptive,
+        store=store,
+    )
+    transport = Transport(
+        pool_maxsize=max(config.http_pool_size, args.workers),
+        timeout=(config.http_connect_timeout, config.http_read_timeout),
+    )
+    processor = Processor(rate_limiter=rate_limiter, transport=transport)
+    try:
+        drainer = DownloadQueueDrainer(processor, args.usernames, args.workers)
+        counts = drainer.drain()
+    finally:
+        processor.close()
+    logger.info(
+        f"{counts['downloaded']} visuals downloaded, {counts['retried']} will be"
+        f" retried later, {counts['failed']} can't be downloaded"
+    )
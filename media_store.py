@@ -0,0 +1,197 @@
+import argparse
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Iterator
+
+import config
+from database import Database
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# blobs younger than this are kept by gc even if nothing links to them yet, a
+# running extractor may be about to
+GC_GRACE_PERIOD = 3600
+
+
+def file_digest(path: str) -> str:
+    """The sha256 of the content of @path, in hex."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentStore:
+    """
+    Keeps a single copy of every distinct visual, named by the sha256 of its
+    content:
+
+        <output directory>/.blobs/<first 2 hex digits>/<sha256>.<ext>
+
+    The usual path of a visual (<output directory>/<uid>/<visual id>) is a hard
+    link to its blob, so the html files and the other scripts see the same files
+    as before. The number of links of a blob is its reference count: once the
+    files that link to it are gone, `gc` removes it.
+
+    Hard links need the blobs on the same file system as the user directories.
+    Where they aren't supported, the visual is stored as a plain file.
+    """
+
+    def __init__(self, directory: str = config.output_directory):
+        self.logger = logging.getLogger(__name__)
+        self.output_directory = directory
+        self.directory = os.path.join(directory, ".blobs")
+        # digest of the files added by this process, by path, until popped
+        self._digests: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._warned = False
+
+    def blob_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.directory, digest[:2], f"{digest}{ext}")
+
+    def add(self, file: str, path: str) -> tuple[str, bool]:
+        """
+        Stores @file, which is then removed, and makes @path a link to its blob.
+        @file may be @path itself. Returns the digest of the content and whether
+        it was stored already.
+        """
+        digest = file_digest(file)
+        stored = False
+        blob = self.blob_path(digest, os.path.splitext(path)[1])
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            try:
+                # a new blob, the file becomes it without copying anything
+                os.link(file, blob)
+            except FileExistsError:
+                if not os.path.samefile(file, blob):
+                    # identical bytes are stored already, drop ours
+                    stored = True
+                    link = f"{path}.link"
+                    os.link(blob, link)
+                    os.replace(link, file)
+        except OSError as e:
+            if not self._warned:
+                self.logger.warning(
+                    f"hard links aren't supported in {self.output_directory},"
+                    f" visuals are stored as plain files: {e}"
+                )
+                self._warned = True
+        if file != path:
+            os.replace(file, path)
+
+        with self._lock:
+            self._digests[os.path.normpath(path)] = digest
+        return digest, stored
+
+    def exists(self, path: str) -> bool:
+        return os.path.isfile(path)
+
+    def pop_digest(self, path: str) -> str | None:
+        """The digest of @path if it was added by this process, forgotten after."""
+        with self._lock:
+            return self._digests.pop(os.path.normpath(path), None)
+
+    def blobs(self) -> Iterator[tuple[str, os.stat_result]]:
+        """The path and stat of every blob."""
+        if not os.path.isdir(self.directory):
+            return
+        for prefix in sorted(os.listdir(self.directory)):
+            directory = os.path.join(self.directory, prefix)
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                yield path, os.stat(path)
+
+    def gc(self, grace: int = GC_GRACE_PERIOD) -> tuple[list[str], int]:
+        """
+        Removes the blobs that no file links to anymore. Returns the digests
+        removed and the bytes reclaimed.
+        """
+        removed = []
+        reclaimed = 0
+        now = time.time()
+        for path, stat in self.blobs():
+            # links change the ctime, not the mtime
+            if stat.st_nlink > 1 or now - stat.st_ctime < grace:
+                continue
+            os.remove(path)
+            removed.append(os.path.splitext(os.path.basename(path))[0])
+            reclaimed += stat.st_size
+        return removed, reclaimed
+
+    def close(self):
+        pass
+
+    def import_directory(self, uid: str) -> tuple[list[tuple[str, str]], int]:
+        """
+        Moves the visuals of @uid that aren't in the store yet into it. Returns
+        the (digest, file name) of the visuals imported, and the bytes saved by
+        storing identical visuals once.
+        """
+        directory = os.path.join(self.output_directory, uid)
+        blobs = []
+        saved = 0
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            if not entry.is_file() or entry.name.endswith((".part", ".link")):
+                continue
+            if entry.stat().st_nlink > 1:
+                # linked to its blob already
+                continue
+            digest, stored = self.add(entry.path, entry.path)
+            self.pop_digest(entry.path)
+            if stored:
+                saved += entry.stat().st_size
+            blobs.append((digest, entry.name))
+        return blobs, saved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="askfm-store",
+        description="manages the content store of the visuals, see media_store in"
+        " config.py",
+    )
+    parser.add_argument(
+        "command",
+        choices=["import", "gc"],
+        help="import: moves the visuals already downloaded into the store,"
+        " gc: removes the stored visuals that no user directory links to anymore",
+    )
+    parser.add_argument("usernames", nargs="*", help="users to import, all by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="time=%(asctime)s  origin=%(name)s level=%(levelname)s msg=%(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logger = logging.getLogger(__name__)
+
+    store = ContentStore()
+    db = Database(config.db_file)
+    db.connect()
+    if args.command == "import":
+        uids = [uid.lower() for uid in args.usernames]
+        if len(uids) == 0:
+            uids = [
+                entry.name
+                for entry in os.scandir(config.output_directory)
+                if entry.is_dir() and not entry.name.startswith(".")
+            ]
+        total = 0
+        for uid in uids:
+            blobs, saved = store.import_directory(uid)
+            db.set_visual_blobs(
+                [(digest, os.path.join("./", uid, name)) for digest, name in blobs]
+            )
+            total += saved
+            logger.info(f"imported {len(blobs)} files of {uid}, {saved} bytes saved")
+        logger.info(f"{total} bytes saved")
+    else:
+        removed, reclaimed = store.gc()
+        db.clear_visual_blobs(removed)
+        logger.info(f"removed {len(removed)} blobs, {reclaimed} bytes reclaimed")
+    db.close()
@@ -0,0 +1,199 @@
+import logging
+import queue
+import threading
+from typing import Callable
+
+import config
+from askfm_model import AskFM, askFMChat
+from database import CheckpointModel, Database
+from processor import ProcessedEntry, Processor
+
+# marks the end of the stream, it is passed down from stage to stage
+_DONE = object()
+
+
+class IngestPipeline:
+    """
+    Stages joined by bounded queues, each running on its own thread:
+
+        put() -> normaliser -> media downloader -> database writer
+
+    The caller keeps reading the profile stream while earlier items are being
+    normalised, their visuals downloaded and written. The media stage only starts
+    the downloads on the processor's `MediaDownloader`, the writer waits for those
+    of each entry before adding it to the batch. The writer is the only
+    stage that touches the database. It commits a batch on every `checkpoint`,
+    together with the checkpoint itself, or once `batch_size` entries are
+    pending. Closing the pipeline (also on Ctrl-C, when used as a context
+    manager) drains every stage and writes the partial batch.
+    """
+
+    def __init__(
+        self, processor: Processor, batch_size: int = 1000, queue_size: int = 1000
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.processor = processor
+        self.batch_size = batch_size
+        self.error: BaseException | None = None
+
+        self._items: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._media: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._writes: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._threads = [
+            self._start("normaliser", self._normalise),
+            self._start("media", self._fetch_media),
+            self._start("writer", self._write),
+        ]
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close(raise_error=exc[0] is None)
+
+    def _start(self, name: str, target: Callable) -> threading.Thread:
+        thread = threading.Thread(target=target, name=f"pipeline-{name}", daemon=True)
+        thread.start()
+        return thread
+
+    def _fail(self, e: BaseException):
+        self.logger.error(
+            f"pipeline stage {threading.current_thread().name} failed: {e}"
+        )
+        if self.error is None:
+            self.error = e
+
+    def queue_sizes(self) -> dict[str, int]:
+        return {
+            "items": self._items.qsize(),
+            "media": self._media.qsize(),
+            "writes": self._writes.qsize(),
+        }
+
+    def put(self, item: AskFM):
+        """Queues a stream item, blocking while the pipeline is full."""
+        if self.error is not None:
+            raise self.error
+        self._items.put(("item", item))
+
+    def put_chats(self, chats: list[askFMChat]):
+        if self.error is not None:
+            raise self.error
+        self._items.put(("chats", chats))
+
+    def update_likes(self, likes: list[tuple[int, int]]):
+        """Queues (like_count, qid) changes of answers that are already stored."""
+        if self.error is not None:
+            raise self.error
+        self._items.put(("likes", likes))
+
+    def checkpoint(
+        self,
+        uid: str,
+        checkpoint: CheckpointModel | None,
+        coverage: list[tuple[int, int]] | None = None,
+    ):
+        """
+        Ends the current batch: everything put so far is committed in the same
+        transaction as @checkpoint, or as the removal of @uid's checkpoint if None,
+        and the (from_ts, to_ts) intervals of @coverage.
+        """
+        if self.error is not None:
+            raise self.error
+        self._items.put(("checkpoint", (uid, checkpoint, coverage)))
+
+    def _normalise(self):
+        while (msg := self._items.get()) is not _DONE:
+            if self.error is not None:
+                continue  # drain so that the producer doesn't block forever
+            kind, payload = msg
+            try:
+                if kind == "item":
+                    entry = self.processor.normalise(payload)
+                    if entry is not None:
+                        self._media.put(("entry", entry))
+                else:
+                    self._media.put(msg)
+            except Exception as e:
+                self._fail(e)
+        self._media.put(_DONE)
+
+    def _fetch_media(self):
+        while (msg := self._media.get()) is not _DONE:
+            if self.error is not None:
+                continue
+            kind, payload = msg
+            try:
+                if kind == "entry":
+                    # the downloads go on while the writer works on earlier entries
+                    self.processor.start_media(payload)
+                self._writes.put(msg)
+            except Exception as e:
+                self._fail(e)
+        self._writes.put(_DONE)
+
+    def _write(self):
+        db = Database(config.db_file)
+        db.connect()
+        entries: list[ProcessedEntry] = []
+        chats: list[askFMChat] = []
+        likes: list[tuple[int, int]] = []
+        try:
+            while (msg := self._writes.get()) is not _DONE:
+                if self.error is not None:
+                    continue
+                kind, payload = msg
+                try:
+                    if kind == "entry":
+                        self.processor.finish_media(payload)
+                        entries.append(payload)
+                        if len(entries) >= self.batch_size:
+                            self._commit(db, entries, chats, likes)
+                    elif kind == "chats":
+                        chats.extend(payload)
+                    elif kind == "likes":
+                        likes.extend(payload)
+                    else:
+                        self._commit(db, entries, chats, likes, *payload)
+                except Exception as e:
+                    self._fail(e)
+
+            if (entries or chats or likes) and self.error is None:
+                self._commit(db, entries, chats, likes)
+        finally:
+            db.close()
+
+    def _commit(
+        self,
+        db: Database,
+        entries: list[ProcessedEntry],
+        chats: list[askFMChat],
+        likes: list[tuple[int, int]],
+        uid: str | None = None,
+        checkpoint: CheckpointModel | None = None,
+        coverage: list[tuple[int, int]] | None = None,
+    ):
+        with db.transaction():
+            self.processor.write(entries, db)
+            self.processor.write_chats(chats, db)
+            db.update_like_counts(likes)
+            if checkpoint is not None:
+                db.save_checkpoint(checkpoint)
+            elif uid is not None:
+                db.delete_checkpoint(uid)
+            for from_ts, to_ts in coverage or []:
+                db.add_coverage(uid, from_ts, to_ts)
+        entries.clear()
+        chats.clear()
+        likes.clear()
+
+    def close(self, raise_error: bool = True):
+        """Waits until everything that was queued is written."""
+        if not self._closed:
+            self._closed = True
+            self._items.put(_DONE)
+            for thread in self._threads:
+                thread.join()
+        if raise_error and self.error is not None:
+            raise self.error
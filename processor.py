@@ -1,11 +1,14 @@
 import json
 import logging
 import os
-from typing import Tuple
+import time
+from concurrent.futures import Future
+from typing import Tuple, TypedDict
 
 import requests
 
 import config
+from askfm_api import RateLimiter, Transport
 from askfm_model import (
     AskFM,
     AskFMAnswer,
@@ -21,6 +24,7 @@ from askfm_model import (
 from database import (
     AnswerModel,
     ChatModel,
+    ChatStateModel,
     Database,
     QuestionModel,
     QueueModel,
@@ -28,14 +32,72 @@ from database import (
     UserModel,
     VisualModel,
 )
+from media import MediaDownloader
+from media_pack import PackStore
+from media_store import ContentStore
+from progress import Progress
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes held in memory per download
+# the visual is gone, retrying won't help
+PERMANENT_STATUS_CODES = {400, 403, 404, 410}
+
+
+class DownloadError(Exception):
+    def __init__(self, message: str, permanent: bool = False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class MediaJob(TypedDict):
+    visual_id: str  # file name without the extension, e.g. a_<qid>
+    url: str
+    uid: str
+    type: str  # gif, photo, video
+    field: str  # the row that references the visual, "question" or "answer"
+
+
+class ProcessedEntry(TypedDict):
+    question: QuestionModel
+    answer: AnswerModel
+    thread: ThreadModel | None
+    media: list[MediaJob]
+    downloads: list[Future]  # of `media`, in the same order
+    visuals: list[VisualModel]  # downloaded
+    queued: list[QueueModel]  # failed downloads
 
 
 class Processor:
 
-    def __init__(self):
+    def __init__(
+        self,
+        rate_limiter: RateLimiter | None = None,
+        transport: Transport | None = None,
+        offline: bool = False,
+        media_workers: int = config.media_workers,
+        media_per_host: int = config.media_per_host,
+    ):
+        """
+        @offline if true, the data comes from archived responses rather than
+            ask.fm: visuals that aren't downloaded yet are added to the download
+            queue instead of being downloaded, and chats are written as in
+            `write_chats`
+        @media_workers visuals downloaded at the same time, @media_per_host of
+            them at most from the same host
+        """
         self.logger = logging.getLogger(__name__)
         self.download_dir = config.output_directory
         self.db = Database(config.db_file)
+        self.rate_limiter = rate_limiter
+        self.transport = transport or Transport()
+        self.offline = offline
+        self.store = None
+        if config.media_store == "content":
+            self.store = ContentStore(self.download_dir)
+        elif config.media_store == "pack":
+            self.store = PackStore(self.download_dir)
+        self.downloader = MediaDownloader(
+            self.download_image, workers=media_workers, per_host=media_per_host
+        )
 
     def process(self, data: list[AskFM]):
         self.db.connect()
@@ -43,49 +105,147 @@ class Processor:
         if len(data) == 0:
             return
 
-        i = 0
+        entries: list[ProcessedEntry] = []
+        with Progress(
+            "writing data to disk", total=len(data), transport=self.transport
+        ) as progress:
+            for item in data:
+                entry = self.normalise(item)
+                if entry is not None:
+                    self.start_media(entry)
+                    entries.append(entry)
+            # the downloads run in the background while the batch is built
+            for entry in entries:
+                self.finish_media(entry)
+                progress.add()
+
+        self.write(entries)
+
+        self.logger.debug("processing finished")
+        self.db.close()
+
+    def normalise(self, item: AskFM) -> ProcessedEntry | None:
+        """
+        Turns a stream item into database rows, without touching the network.
+        The visuals still have to be downloaded by `fetch_media`.
+        """
+        if item["type"] != "question":
+            return None
+
+        d = item["data"]
+        media = []
+        if (job := self._question_media(d)) is not None:
+            media.append(job)
+        if (job := self._answer_media(d)) is not None:
+            media.append(job)
+
+        return ProcessedEntry(
+            question=self._process_question(d),
+            answer=self._process_answer(d),
+            thread=self._process_thread(d),
+            media=media,
+            downloads=[],
+            visuals=[],
+            queued=[],
+        )
+
+    def fetch_media(self, entry: ProcessedEntry):
+        """Downloads the visuals of @entry and fills in their ids and rows."""
+        self.start_media(entry)
+        self.finish_media(entry)
+
+    def start_media(self, entry: ProcessedEntry):
+        """Starts downloading the visuals of @entry on the downloader's workers."""
+        for job in entry["media"]:
+            path = os.path.join(self.download_dir, job["uid"], job["visual_id"])
+            entry["downloads"].append(self.downloader.submit(job["url"], path))
+
+    def finish_media(self, entry: ProcessedEntry):
+        """
+        Waits for the downloads started by `start_media` and fills in the ids and
+        rows of @entry's visuals.
+        """
+        for job, download in zip(entry["media"], entry["downloads"]):
+            visual_id, ok = download.result()
+            relative = os.path.join("./", job["uid"], visual_id)
+            blob = None
+            if ok and self.store is not None:
+                path = os.path.join(self.download_dir, job["uid"], visual_id)
+                blob = self.store.pop_digest(path)
+            if not ok:
+                self.logger.info(
+                    f"failed to downloda visual for {visual_id}, adding to failed queue"
+                )
+                entry["queued"].append(
+                    QueueModel(
+                        id=visual_id,
+                        url=job["url"],
+                        directory=relative,
+                        type=job["type"],
+                    )
+                )
+            else:
+                entry["visuals"].append(
+                    VisualModel(
+                        id=visual_id, directory=relative, type=job["type"], blob=blob
+                    )
+                )
+            entry[job["field"]]["visual_id"] = visual_id
+        entry["downloads"].clear()
+
+    def write(self, entries: list[ProcessedEntry], db: Database | None = None):
+        """
+        Writes a batch of processed entries, @db must be connected. Offline, the
+        questions and answers are written over the stored ones, e.g. after a fix
+        to the processing.
+        """
+        db = db or self.db
         questions = []
         q_keys = None
         answers = []
         a_keys = None
         threads = []
         t_keys = None
-        for entry in data:
-            i += 1
-            if entry["type"] != "question":
-                continue
+        for entry in entries:
+            for visual in entry["visuals"]:
+                db.add_visual(visual=visual)
+            for visual in entry["queued"]:
+                db.add_download_queue(visual=visual)
 
-            d = entry["data"]
-            question = self._process_question(d)
+            question = entry["question"]
             questions.append(tuple(question.values()))
             if q_keys is None:
                 q_keys = question.keys()
 
-            answer = self._process_answer(d)
-            # add like_count as an additional value to satisfy query args
+            answer = entry["answer"]
             a_values = list(answer.values())
-            a_values.append(answer["like_count"])
+            if not self.offline:
+                # add like_count as an additional value to satisfy query args
+                a_values.append(answer["like_count"])
             answers.append(tuple(a_values))
             if a_keys is None:
                 a_keys = answer.keys()
 
-            thread = self._process_thread(d)
+            thread = entry["thread"]
             if thread is not None:
                 threads.append(tuple(thread.values()))
                 if t_keys is None:
                     t_keys = thread.keys()
 
-            print(
-                f"Progress: {i/len(data)*100:.1f}% - writing data to disk\033[K",
-                end="\r",
-            )
-
-        self.db.add_questions(q_keys, questions)
-        self.db.add_answers(a_keys, answers)
-        self.db.add_threads(t_keys, threads)
+        if len(entries) == 0:
+            return
+        if self.offline:
+            db.add_questions(q_keys, questions, replace=True)
+            db.replace_answers(a_keys, answers)
+        else:
+            db.add_questions(q_keys, questions)
+            db.add_answers(a_keys, answers)
+        db.add_threads(t_keys, threads)
 
-        self.logger.debug("processing finished")
-        self.db.close()
+    def close(self):
+        self.downloader.close()
+        if self.store is not None:
+            self.store.close()
 
     def process_profile(self, data: askFMProfileDetails):
         urls = {}
@@ -114,13 +274,24 @@ class Processor:
         for filename, url in urls.items():
             path = os.path.join(self.download_dir, uid, filename)
             visual_id, ok = self.download_image(url=url, path=path)
+            if ok and self.store is not None:
+                # profile pictures have no row to keep the digest in
+                self.store.pop_digest(os.path.join(self.download_dir, uid, visual_id))
 
-        blob = json.dumps(data)
-        user = UserModel(id=uid, name=data["fullName"], blob=blob)
+        # the details are stored by `save_profile`, once the answers are
+        user = UserModel(id=uid, name=data["fullName"], blob=None)
 
         self.db.connect()
         self.db.add_user(user)
-        self.db.update_user_blob(id=uid, blob=blob)
+        self.db.close()
+
+    def save_profile(self, data: askFMProfileDetails):
+        """
+        Stores @data as the details the next run compares the profile with, so it
+        must only be called once the profile's answers are archived.
+        """
+        self.db.connect()
+        self.db.update_user_blob(id=data["uid"].lower(), blob=json.dumps(data))
         self.db.close()
 
     def _process_question(self, data: AskFMData) -> QuestionModel:
@@ -140,88 +311,49 @@ class Processor:
             text=data["body"],
             author_id=data["author"],
             author_name=data["authorName"],
-            visual_id=self.__process_visual_from_question(data),
+            visual_id=None,  # set by fetch_media
             created_at=data["createdAt"],
         )
 
         return question
 
-    def __process_visual_from_question(self, data: AskFMData) -> str | None:
+    def _question_media(self, data: AskFMData) -> MediaJob | None:
         if data.get("questionPhotoInfo") is None:
             return None
 
-        visual_id = f"q_{data['qid']}"
-        path = os.path.join(
-            self.download_dir, data["answer"]["author"].lower(), visual_id
-        )
-        visual_id, ok = self.download_image(
-            url=data["questionPhotoInfo"]["photoUrl"], path=path
+        return MediaJob(
+            visual_id=f"q_{data['qid']}",
+            url=data["questionPhotoInfo"]["photoUrl"],
+            uid=data["answer"]["author"].lower(),
+            type="photo",
+            field="question",
         )
-        relative = os.path.join("./", data["answer"]["author"].lower(), visual_id)
-        if not ok:
-            self.logger.info(
-                f"failed to downloda visual for {visual_id}, adding to failed queue"
-            )
-            self.db.add_download_queue(
-                visual=QueueModel(
-                    id=visual_id,
-                    url=data["questionPhotoInfo"]["photoUrl"],
-                    directory=relative,
-                    type="photo",
-                )
-            )
-        else:
-            self.db.add_visual(
-                visual=VisualModel(id=visual_id, directory=relative, type="photo")
-            )
-
-        return visual_id
 
     def _process_answer(self, data: AskFMData) -> AnswerModel:
         answer = AnswerModel(
             qid=data["qid"],
             uid=data["answer"]["author"].lower(),
             text=data["answer"].get("body"),
-            visual_id=self.__process_visual_from_answer(data),
+            visual_id=None,  # set by fetch_media
             like_count=data["answer"].get("likeCount", 0),
             created_at=data["answer"]["createdAt"],
         )
 
         return answer
 
-    def __process_visual_from_answer(self, data: AskFMData) -> str | None:
+    def _answer_media(self, data: AskFMData) -> MediaJob | None:
         photo = data["answer"].get("photoUrl")
         video = data["answer"].get("videoUrl")
         if photo is None and video is None:
             return None
 
-        visual_url = photo if photo is not None else video
-        visual_id = f"a_{data['qid']}"
-        path = os.path.join(
-            self.download_dir, data["answer"]["author"].lower(), visual_id
+        return MediaJob(
+            visual_id=f"a_{data['qid']}",
+            url=photo if photo is not None else video,
+            uid=data["answer"]["author"].lower(),
+            type=data["answer"]["type"],
+            field="answer",
         )
-        visual_id, ok = self.download_image(url=visual_url, path=path)
-        relative = os.path.join("./", data["answer"]["author"].lower(), visual_id)
-        if not ok:
-            self.logger.info(
-                f"failed to downloda visual for {visual_id}, adding to failed queue"
-            )
-            self.db.add_download_queue(
-                visual=QueueModel(
-                    id=visual_id,
-                    url=visual_url,
-                    directory=relative,
-                    type=data["answer"]["type"],
-                )
-            )
-        else:
-            self.db.add_visual(
-                visual=VisualModel(
-                    id=visual_id, directory=relative, type=data["answer"]["type"]
-                )
-            )
-
-        return visual_id
 
     def _process_thread(self, data: AskFMData) -> ThreadModel | None:
         if data.get("thread") is None:
@@ -237,29 +369,95 @@ class Processor:
     def process_chat(self, datas: list[askFMChat]):
         self.logger.debug("processing chats started")
         self.db.connect()
+        self.write_chats(datas)
+        self.logger.debug("processing chats ended")
+        self.db.close()
+
+    def write_chats(self, datas: list[askFMChat], db: Database | None = None):
+        """
+        Writes the messages of @datas that are newer than the ones already stored,
+        and the state of each chat, @db must be connected.
+
+        Offline, @datas are archived responses that may be older than what is
+        stored: all of their messages are written over the stored ones, and a
+        state only moves forward to newer messages, without counting as a check
+        of the chat.
+        """
+        db = db or self.db
+        now = int(time.time())
+        states = db.get_chat_states([data["root"]["qid"] for data in datas])
+        chats = []
+        new_states = {}
         for data in datas:
+            qid = data["root"]["qid"]
             if data.get("messages", None) is None:
-                self.logger.debug(f'chat for qid={data["root"]["qid"]} is gone')
+                self.logger.debug(f"chat for qid={qid} is gone")
                 continue
-            for message in data["messages"]:
-                chat = ChatModel(
-                    id=message["id"],
-                    uid=data["owner"]["uid"],
-                    qid=data["root"]["qid"],
-                    text=message["text"],
-                    author_id=message.get("uid"),
-                    author_name=message.get("fullName"),
-                    created_at=message["createdAt"],
+
+            state = new_states.get(qid) or states.get(qid)
+            last = None
+            if state is not None and state["last_message_id"] is not None:
+                last = (state["last_message_at"], state["last_message_id"])
+            messages = [
+                message
+                for message in data["messages"]
+                if last is None or (message["createdAt"], message["id"]) > last
+            ]
+            for message in data["messages"] if self.offline else messages:
+                chats.append(
+                    ChatModel(
+                        id=message["id"],
+                        uid=data["owner"]["uid"],
+                        qid=qid,
+                        text=message["text"],
+                        author_id=message.get("uid"),
+                        author_name=message.get("fullName"),
+                        created_at=message["createdAt"],
+                    )
                 )
-                self.db.add_chat(chat)
-        self.logger.debug("processing chats ended")
-        self.db.close()
+            if self.offline and state is not None and len(messages) == 0:
+                continue
+            for message in messages:
+                if last is None or (message["createdAt"], message["id"]) > last:
+                    last = (message["createdAt"], message["id"])
+
+            checked_at = now
+            if self.offline:
+                # due for a check on the next run unless one was recorded
+                checked_at = state["checked_at"] if state else 0
+            new_states[qid] = ChatStateModel(
+                qid=qid,
+                last_message_id=last[1] if last else None,
+                last_message_at=last[0] if last else None,
+                message_count=(state["message_count"] if state else 0) + len(messages),
+                has_older=bool(data.get("hasOlder", False)),
+                checked_at=checked_at,
+            )
+
+        db.add_chats(chats, replace=self.offline)
+        db.save_chat_states(list(new_states.values()))
 
     def download_image(self, url: str, path: str) -> Tuple[str, bool]:
+        """
+        Returns the visual id, the file name with its extension, and true once it's
+        saved, or the file name without extension and false if it couldn't be.
+        """
+        try:
+            return self.download_visual(url, path), True
+        except DownloadError as ex:
+            log = self.logger.debug if self.offline else self.logger.error
+            log(f"error download image: {os.path.basename(path)}: {ex}")
+            return os.path.basename(path), False
+
+    def download_visual(self, url: str, path: str) -> str:
+        """
+        Saves the visual at @url as @path plus the url's extension and returns its
+        file name. Raises DownloadError if it couldn't be saved.
+        """
         dir = os.path.dirname(path)
         if not os.path.exists(dir):
             self.logger.info(f"output directory doesn't exist, creating it... {dir}")
-            os.makedirs(dir)
+            os.makedirs(dir, exist_ok=True)
 
         filename = os.path.basename(path)
         tokens = url.split(".")
@@ -270,19 +468,73 @@ class Processor:
         # file already exists, we may have downloaded it before using the old
         # extractor, so skip and return true
         if os.path.isfile(f"{path}.{ext}"):
-            return f"{filename}.{ext}", True
+            return f"{filename}.{ext}"
+        if self.store is not None and self.store.exists(f"{path}.{ext}"):
+            return f"{filename}.{ext}"
+        if self.offline:
+            raise DownloadError("offline")
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire("media")
+
+        # streamed to a partial file that is moved once complete, so that a
+        # file that exists is always whole and a broken download can be resumed
+        path = os.path.join(dir, f"{filename}.{ext}")
+        partial = f"{path}.part"
+        offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+        # the size on disk has to match Content-Length, so no transfer encoding
+        headers = {"Accept-Encoding": "identity"}
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+        try:
+            with self.transport.get(url, headers=headers, stream=True) as response:
+                self._save_response(response, partial, offset)
+            if self.store is not None:
+                self.store.add(partial, path)
+            else:
+                os.replace(partial, path)
+        except requests.RequestException as ex:
+            raise DownloadError(str(ex)) from ex
+        except OSError as ex:
+            raise DownloadError(f"error saving to {filename}.{ext}: {ex}") from ex
+
+        return f"{filename}.{ext}"
+
+    def _save_response(self, response: requests.Response, partial: str, offset: int):
+        """
+        Appends the body of @response to @partial, which already has @offset bytes,
+        in chunks. Raises DownloadError if the file isn't complete.
+        """
+        received = 0
+        try:
+            if response.status_code == 206:
+                mode = "ab"
+                # bytes <start>-<end>/<size>
+                content_range = response.headers.get("Content-Range", "")
+                start = content_range.removeprefix("bytes ").split("-")[0]
+                if not start.isdigit() or int(start) != offset:
+                    if os.path.isfile(partial):
+                        os.remove(partial)
+                    raise DownloadError(f"bad range {content_range}")
+            elif response.status_code == 200:
+                # sent from the start, e.g. the server doesn't support ranges
+                mode = "wb"
+            else:
+                if response.status_code == 416:
+                    # the partial file doesn't match the remote one anymore
+                    os.remove(partial)
+                raise DownloadError(
+                    f"status {response.status_code}",
+                    permanent=response.status_code in PERMANENT_STATUS_CODES,
+                )
 
-        response = requests.get(url)
-        if response.status_code != 200:
-            self.logger.error(f"error download image: {filename}")
-            return filename, False
+            with open(partial, mode) as handler:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    handler.write(chunk)
+                    received += len(chunk)
+        finally:
+            self.transport.account(response.url, response, received)
 
-        try:
-            path = os.path.join(dir, f"{filename}.{ext}")
-            with open(path, "wb") as handler:
-                handler.write(response.content)
-        except Exception as ex:
-            self.logger.error(f"error saving image to {filename}.{ext}: {ex}")
-            return filename, False
-
-        return f"{filename}.{ext}", True
+        expected = response.headers.get("Content-Length")
+        if expected is not None and received != int(expected):
+            raise DownloadError(f"received {received} of {expected} bytes, will resume")
@@ -0,0 +1,136 @@
+import json
+import sys
+import threading
+import time
+from typing import Callable, TextIO
+
+import config
+from askfm_api import Transport
+
+
+class Progress:
+    """
+    Progress of a long-running step, reported at most every @interval seconds
+    however often it is counted.
+
+    On a terminal a single status line is redrawn: items done, items/s, API
+    pages/s, chats/s, media MB/s, the depths of the pipeline's queues and an
+    ETA once the total is known. Otherwise, e.g. when the output is piped into
+    a log, a JSON summary is written every `progress_log_interval` seconds and
+    when the step ends.
+    """
+
+    def __init__(
+        self,
+        label: str,
+        total: int | None = None,
+        transport: Transport | None = None,
+        queues: Callable[[], dict[str, int]] | None = None,
+        stream: TextIO | None = None,
+    ):
+        """
+        @total items expected, the percentage and the ETA are left out if unknown
+        @transport whose requests to `api_host` are counted as pages, and the bytes
+            received from any other host as media
+        @queues returns the current depth of each queue
+        """
+        self.label = label
+        self.total = total if total else None
+        self.transport = transport
+        self.queues = queues
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.interval = config.progress_interval
+        if not self.tty:
+            self.interval = config.progress_log_interval
+
+        self.counts = {"items": 0, "chats": 0}
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._reported = self._started
+        self._base = self._transport_counts()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, name: str = "items", n: int = 1):
+        """Counts @n more @name, thread safe."""
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+            now = time.monotonic()
+            if now - self._reported < self.interval:
+                return
+            self._reported = now
+        self._report()
+
+    def _transport_counts(self) -> tuple[int, int]:
+        if self.transport is None:
+            return 0, 0
+        pages = media = 0
+        for host, stats in self.transport.stats().items():
+            if host == config.api_host:
+                pages += stats["requests"]
+            else:
+                media += stats["bytes"]
+        return pages, media
+
+    def snapshot(self) -> dict:
+        """The counts and rates since the step started."""
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        pages, media = self._transport_counts()
+        pages -= self._base[0]
+        media -= self._base[1]
+        items = self.counts["items"]
+        items_per_s = items / elapsed
+
+        eta = None
+        if self.total is not None and items_per_s > 0:
+            eta = max(self.total - items, 0) / items_per_s
+
+        return {
+            "progress": self.label,
+            "items": items,
+            "total": self.total,
+            "elapsed_s": round(elapsed, 1),
+            "items_per_s": round(items_per_s, 1),
+            "pages_per_s": round(pages / elapsed, 2),
+            "chats_per_s": round(self.counts["chats"] / elapsed, 2),
+            "media_mb_per_s": round(media / elapsed / 1e6, 3),
+            "queues": self.queues() if self.queues is not None else {},
+            "eta_s": round(eta) if eta is not None else None,
+        }
+
+    def _line(self, s: dict) -> str:
+        line = f"{s['progress']}: {s['items']}"
+        if s["total"] is not None:
+            percent = min(s["items"] / s["total"] * 100, 100)
+            line += f"/{s['total']} ({percent:.1f}%)"
+        line += (
+            f" | {s['items_per_s']:.0f} items/s, {s['pages_per_s']:.1f} pages/s,"
+            f" {s['chats_per_s']:.1f} chats/s, {s['media_mb_per_s']:.2f} MB/s media"
+        )
+        if s["queues"]:
+            line += " | queues " + "/".join(str(size) for size in s["queues"].values())
+        if s["eta_s"] is not None:
+            minutes, seconds = divmod(s["eta_s"], 60)
+            line += f" | ETA {minutes}:{seconds:02d}"
+        return line
+
+    def _report(self, final: bool = False):
+        s = self.snapshot()
+        if self.tty:
+            self.stream.write(f"{self._line(s)}\033[K" + ("\n" if final else "\r"))
+        else:
+            s["final"] = final
+            self.stream.write(json.dumps(s) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        """Reports the final counts."""
+        if not self._closed:
+            self._closed = True
+            self._report(final=True)
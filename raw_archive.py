@@ -0,0 +1,121 @@
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterator, TypedDict
+
+import config
+from askfm_api import Request
+
+# the responses kept, by path, and the name of their segments
+ARCHIVED_PATHS = {"/users/profile/stream": "stream", "/answers/chats": "chats"}
+
+
+class RawRecord(TypedDict):
+    ts: int  # when the response was received
+    params: dict  # of the request, without the signing ones
+    response: dict
+
+
+class _Segment:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = gzip.open(path, "ab")
+        self.size = 0  # uncompressed bytes written
+
+
+class RawArchive:
+    """
+    Appends the raw JSON of the profile stream pages and chats received from the
+    API to gzip'ed, append-only JSON lines segments, one set per user and kind:
+
+        <directory>/<uid>/<kind>-<opened at>-<pid>-<n>.jsonl.gz
+
+    Every process writes its own segments and starts a new one after
+    @segment_size uncompressed bytes. Records are flushed as they are written,
+    so a crash loses at most the one being written. Pass an instance as the
+    `on_response` of the API sessions.
+    """
+
+    def __init__(
+        self,
+        directory: str = config.raw_archive_directory,
+        segment_size: int = config.raw_archive_segment_size,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.segment_size = segment_size
+        self._segments: dict[tuple[str, str], _Segment] = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, req: Request, params: dict, res: dict):
+        kind = ARCHIVED_PATHS.get(req.path)
+        if kind is None:
+            return
+        uid = self._uid(kind, params, res)
+        if uid is None:
+            return
+        record = RawRecord(ts=int(time.time()), params=params, response=res)
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+
+        with self._lock:
+            segment = self._segment(uid, kind)
+            segment.file.write(line)
+            segment.file.flush()
+            segment.size += len(line)
+            if segment.size >= self.segment_size:
+                segment.file.close()
+                del self._segments[(uid, kind)]
+
+    def _uid(self, kind: str, params: dict, res: dict) -> str | None:
+        if kind == "stream":
+            return params.get("uid", "").lower() or None
+        if res.get("owner"):
+            return res["owner"]["uid"].lower()
+        answer = (res.get("root") or {}).get("answer")
+        if answer:
+            return answer["author"].lower()
+        return None
+
+    def _segment(self, uid: str, kind: str) -> _Segment:
+        segment = self._segments.get((uid, kind))
+        if segment is None:
+            directory = os.path.join(self.directory, uid)
+            os.makedirs(directory, exist_ok=True)
+            self._count += 1
+            opened_at = time.strftime("%Y%m%d%H%M%S")
+            name = f"{kind}-{opened_at}-{os.getpid()}-{self._count:04d}.jsonl.gz"
+            segment = _Segment(os.path.join(directory, name))
+            self._segments[(uid, kind)] = segment
+            self.logger.debug(f"archiving raw {kind} of {uid} in {segment.path}")
+        return segment
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.file.close()
+            self._segments.clear()
+
+
+def read_segments(
+    uid: str, kind: str, directory: str = config.raw_archive_directory
+) -> Iterator[RawRecord]:
+    """
+    The records of @uid's @kind segments, oldest segment first. The record that a
+    crash left half written at the end of a segment is skipped.
+    """
+    logger = logging.getLogger(__name__)
+    pattern = os.path.join(directory, uid.lower(), f"{kind}-*.jsonl.gz")
+    for path in sorted(glob.glob(pattern)):
+        try:
+            with gzip.open(path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile) as e:
+            logger.warning(f"{path} ends with a truncated record: {e}")
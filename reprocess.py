@@ -0,0 +1,86 @@
+import argparse
+import logging
+
+import config
+from askfm_model import AskFM, askFMChat
+from processor import Processor
+from raw_archive import read_segments
+
+BATCH_SIZE = 1000
+
+
+def reprocess_stream(uid: str, processor: Processor) -> int:
+    """
+    Writes the answers of @uid's archived profile stream pages again, oldest
+    first so that the latest like counts win.
+    """
+    count = 0
+    batch: list[AskFM] = []
+    for record in read_segments(uid, "stream"):
+        batch.extend(record["response"].get("items") or [])
+        if len(batch) >= BATCH_SIZE:
+            processor.process(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        processor.process(batch)
+        count += len(batch)
+    return count
+
+
+def reprocess_chats(uid: str, processor: Processor) -> int:
+    """
+    Writes the messages of @uid's archived chats again. The older pages of a chat
+    (requested with `from`) are merged into the chat fetched right before them.
+    """
+    count = 0
+    chats: dict[int, askFMChat] = {}
+    for record in read_segments(uid, "chats"):
+        chat: askFMChat = record["response"]
+        qid = chat["root"]["qid"]
+        if record["params"].get("from") is not None and qid in chats:
+            chats[qid]["messages"] = chat["messages"] + chats[qid]["messages"]
+            chats[qid]["hasOlder"] = chat.get("hasOlder", False)
+            continue
+
+        if qid in chats:
+            processor.process_chat([chats.pop(qid)])
+            count += 1
+        chats[qid] = chat
+        if len(chats) >= BATCH_SIZE:
+            # the pages of a chat are fetched one after the other, so chats
+            # fetched long ago are complete
+            oldest = list(chats)[: BATCH_SIZE // 2]
+            processor.process_chat([chats.pop(old) for old in oldest])
+            count += len(oldest)
+
+    processor.process_chat(list(chats.values()))
+    return count + len(chats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="askfm-reprocess",
+        description="writes the raw API responses archived for the specified users"
+        " to the database again, without any request to ask.fm",
+    )
+    parser.add_argument("usernames", nargs="+")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="time=%(asctime)s  origin=%(name)s level=%(levelname)s msg=%(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logger = logging.getLogger(__name__)
+    if not config.raw_archive_directory:
+        logger.error("raw_archive_directory is not set in config.py")
+        exit(-1)
+
+    # visuals that were never downloaded go to the download queue
+    processor = Processor(offline=True)
+    for uid in args.usernames:
+        uid = uid.lower()
+        answers = reprocess_stream(uid, processor)
+        chats = reprocess_chats(uid, processor)
+        logger.info(f"reprocessed {answers} stream items and {chats} chats of {uid}")
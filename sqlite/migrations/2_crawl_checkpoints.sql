@@ -0,0 +1,10 @@
+CREATE TABLE `crawl_checkpoints` (
+    `uid` varchar(255) not null primary key,
+    `mode` varchar(16) not null,
+    `windows` text not null,
+    `batch` integer not null,
+    `answers` integer not null,
+    `started_at` datetime not null,
+    `updated_at` datetime not null,
+    foreign key(`uid`) references `users`(`id`)
+);
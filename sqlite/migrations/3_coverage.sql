@@ -0,0 +1,7 @@
+CREATE TABLE `coverage` (
+    `uid` varchar(255) not null,
+    `from_ts` datetime not null,
+    `to_ts` datetime not null,
+    primary key(`uid`, `from_ts`),
+    foreign key(`uid`) references `users`(`id`)
+);
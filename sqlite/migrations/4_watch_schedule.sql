@@ -0,0 +1,7 @@
+CREATE TABLE `watch_schedule` (
+    `uid` varchar(255) not null primary key,
+    `next_check_at` datetime not null,
+    `last_check_at` datetime,
+    `interval` integer not null,
+    foreign key(`uid`) references `users`(`id`)
+);
@@ -0,0 +1,9 @@
+CREATE TABLE `chat_state` (
+    `qid` integer not null primary key,
+    `last_message_id` integer,
+    `last_message_at` datetime,
+    `message_count` integer not null,
+    `has_older` boolean not null,
+    `checked_at` datetime not null,
+    foreign key(`qid`) references `questions`(`qid`)
+);
@@ -0,0 +1,6 @@
+ALTER TABLE `download_queue` ADD COLUMN `attempts` integer not null default 0;
+ALTER TABLE `download_queue` ADD COLUMN `next_attempt_at` datetime not null default 0;
+ALTER TABLE `download_queue` ADD COLUMN `last_error` text;
+ALTER TABLE `download_queue` ADD COLUMN `failed` boolean not null default 0;
+
+CREATE INDEX `index_download_queue_next_attempt_at` on `download_queue` (`failed`, `next_attempt_at`);
@@ -0,0 +1,3 @@
+ALTER TABLE `visuals` ADD COLUMN `blob` varchar(64);
+
+CREATE INDEX `index_visuals_blob` on `visuals` (`blob`);
@@ -0,0 +1,12 @@
+CREATE TABLE `packed_visuals` (
+    `path` varchar(255) not null primary key,
+    `pack` varchar(255) not null,
+    `offset` integer not null,
+    `length` integer not null,
+    `type` varchar(255) not null,
+    `sha256` varchar(64) not null
+);
+
+CREATE INDEX `index_packed_visuals_sha256` on `packed_visuals` (`sha256`);
+
+CREATE INDEX `index_packed_visuals_pack` on `packed_visuals` (`pack`, `offset`);
@@ -0,0 +1,426 @@
+#
+#
+# A local stand-in for the ask.fm API, serving a synthetic seeded dataset.
+# It checks request signatures and the rolling request token like the real
+# service does, and can add latency, errors and throttling for load tests.
+#
+#
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import random
+import re
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# 2012-01-01, the synthetic timelines start here
+DATASET_EPOCH = 1325376000
+
+
+@dataclass
+class FakeOptions:
+    api_key: str = "fake-key"
+    seed: int = 0
+    answers: int = 1000  # answers per user
+    chat_ratio: float = 0.1  # share of answers that have a chat
+    photo_ratio: float = 0.05  # share of answers with a photo
+    latency: float = 0.0  # seconds added to every response
+    jitter: float = 0.0  # random extra latency, up to this many seconds
+    error_rate: float = 0.0  # share of requests failing with try_again
+    session_ttl: float = 0.0  # seconds before a token expires, 0 for never
+    # requests per second per client before throttling, 0 for unlimited
+    rate: float = 0.0
+
+
+class FakeAskfm:
+    """The state of the fake service: issued tokens, their rt chains and the dataset."""
+
+    def __init__(self, options: FakeOptions):
+        self.options = options
+        self.tokens: dict[str, dict] = {}  # token -> {"rt", "issued_at", "uid"}
+        self.clients: dict[str, tuple[float, float]] = {}  # ip -> (tokens, updated_at)
+        self.lock = threading.Lock()
+        self._timelines: dict[str, list[dict]] = {}
+        self._questions: dict[int, dict] = {}  # qid -> AskFMData
+
+    # === Signing ===
+
+    def signature(self, method: str, host: str, path: str, params: dict) -> str:
+        quoted = [key + "%" + quote(val, safe="!'()~") for key, val in params.items()]
+        msg = "%".join([method, host, path, "%".join(sorted(quoted))])
+        return hmac.new(self.options.api_key.encode(), msg.encode(), "sha1").hexdigest()
+
+    def issue_token(self, uid: str | None) -> tuple[str, str]:
+        token = ("." + secrets.token_hex(16)) if uid else secrets.token_hex(16)
+        rt = secrets.token_hex(4)
+        with self.lock:
+            self.tokens[token] = {"rt": rt, "issued_at": time.time(), "uid": uid}
+        return token, rt
+
+    def rotate(self, token: str, rt: str) -> tuple[str | None, str | None]:
+        """Check @rt against the chain of @token, return (error, next rt)."""
+        with self.lock:
+            session = self.tokens.get(token)
+            if session is None:
+                return "invalid_access_token", None
+            ttl = self.options.session_ttl
+            if ttl and time.time() - session["issued_at"] > ttl:
+                del self.tokens[token]
+                return "session_expired", None
+            if session["rt"] != rt:
+                return "invalid_request_token", None
+            session["rt"] = secrets.token_hex(4)
+            return None, session["rt"]
+
+    def throttled(self, client: str) -> float:
+        """Token bucket per client, return 0 or the seconds to wait."""
+        rate = self.options.rate
+        if not rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            tokens, updated_at = self.clients.get(client, (rate, now))
+            tokens = min(rate, tokens + (now - updated_at) * rate)
+            if tokens < 1:
+                self.clients[client] = (tokens, now)
+                return (1 - tokens) / rate
+            self.clients[client] = (tokens - 1, now)
+            return 0
+
+    # === Dataset ===
+
+    def profile(self, uid: str, base_url: str) -> dict:
+        rng = random.Random(f"{self.options.seed}:{uid}:profile")
+        return {
+            "uid": uid,
+            "fullName": uid.capitalize(),
+            "answerCount": self.options.answers,
+            "likeCount": rng.randint(0, 10 * self.options.answers),
+            "bio": f"synthetic profile of {uid}",
+            "location": "",
+            "webSite": "",
+            "avatarUrl": f"{base_url}/media/avatar_{uid}.jpg",
+            "backgroundUrl": f"{base_url}/media/background_{uid}.jpg",
+            "pictures": [
+                {"id": str(i), "url": f"{base_url}/media/picture_{uid}_{i}.jpg"}
+                for i in range(rng.randint(0, 3))
+            ],
+        }
+
+    def timeline(self, uid: str, base_url: str) -> list[dict]:
+        """The stream items of @uid, newest first."""
+        with self.lock:
+            if uid in self._timelines:
+                return self._timelines[uid]
+
+        rng = random.Random(f"{self.options.seed}:{uid}:timeline")
+        user_no = int(hashlib.sha1(uid.encode()).hexdigest()[:6], 16)
+        items = []
+        ts = DATASET_EPOCH
+        for i in range(self.options.answers):
+            ts += rng.randint(60, 86400)
+            qid = user_no * 10_000_000 + i + 1
+            answer = {
+                "author": uid,
+                "authorName": uid.capitalize(),
+                "type": "text",
+                "body": f"answer {i} of {uid}",
+                "likeCount": rng.randint(0, 50),
+                "createdAt": ts,
+            }
+            if rng.random() < self.options.photo_ratio:
+                answer["type"] = "photo"
+                answer["photoUrl"] = f"{base_url}/media/a_{qid}.jpg"
+            data = {
+                "type": "anonymous",
+                "body": f"question {i} for {uid}",
+                "qid": qid,
+                "author": None,
+                "authorName": None,
+                "createdAt": ts - rng.randint(1, 3600),
+                "chat": rng.random() < self.options.chat_ratio,
+                "answer": answer,
+            }
+            items.append({"type": "question", "ts": ts, "data": data})
+        items.reverse()
+
+        with self.lock:
+            self._timelines[uid] = items
+            for item in items:
+                self._questions[item["data"]["qid"]] = item["data"]
+        return items
+
+    def find(self, qid: int) -> dict | None:
+        """The question @qid, if the timeline holding it was already generated."""
+        with self.lock:
+            return self._questions.get(qid)
+
+    def chat(self, data: dict) -> dict:
+        rng = random.Random(f"{self.options.seed}:{data['qid']}:chat")
+        owner = data["answer"]["author"]
+        ts = data["answer"]["createdAt"]
+        messages = []
+        for i in range(rng.randint(1, 8)):
+            ts += rng.randint(10, 3600)
+            own = i % 2 == 1
+            messages.append(
+                {
+                    "id": data["qid"] * 100 + i,
+                    "uid": owner if own else None,
+                    "fullName": owner.capitalize() if own else None,
+                    "avatarUrl": "",
+                    "text": f"message {i}",
+                    "createdAt": ts,
+                    "isOwn": own,
+                }
+            )
+        return {
+            "root": data,
+            "messages": messages,
+            "hasOlder": False,
+            "owner": {"uid": owner, "fullName": owner.capitalize()},
+        }
+
+    def media(self, name: str) -> bytes:
+        rng = random.Random(f"{self.options.seed}:{name}")
+        return rng.randbytes(rng.randint(2_000, 50_000))
+
+
+class FakeAskfmHandler(BaseHTTPRequestHandler):
+    server: "FakeAskfmServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        self.handle_api("GET")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+    def do_PUT(self):
+        self.handle_api("PUT")
+
+    def do_DELETE(self):
+        self.handle_api("DELETE")
+
+    def send_json(self, body: dict, status: int = 200, headers: dict | None = None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_params(self, method: str) -> dict[str, str]:
+        url = urlsplit(self.path)
+        if method in ["POST", "PUT"]:
+            length = int(self.headers.get("Content-Length") or 0)
+            form = parse_qs(self.rfile.read(length).decode(), keep_blank_values=True)
+            return {k: v[0] for k, v in form.items()}
+        query = parse_qs(url.query, keep_blank_values=True)
+        return {k: v[0] for k, v in query.items()}
+
+    def handle_api(self, method: str):
+        fake = self.server.fake
+        options = fake.options
+        path = urlsplit(self.path).path
+        params = self.read_params(method)
+
+        delay = options.latency + random.uniform(0, options.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if path.startswith("/media/"):
+            self.serve_media(path[len("/media/") :])
+            return
+
+        wait = fake.throttled(self.client_address[0])
+        if wait:
+            self.send_json({"error": "try_again"}, 429, {"Retry-After": f"{wait:.3f}"})
+            return
+
+        host = self.headers.get("Host", "")
+        signature = fake.signature(method, host, path, params)
+        if self.headers.get("Authorization") != f"HMAC {signature}":
+            self.send_json({"error": "invalid_signature"}, 400)
+            return
+
+        if method in ["POST", "PUT"]:
+            params = {**json.loads(params.get("json", "{}")), **params}
+
+        headers = {}
+        if path not in ["/token", "/authorize"] or self.headers.get("X-Access-Token"):
+            token = self.headers.get("X-Access-Token", "")
+            if path != "/token":
+                error, rt = fake.rotate(token, params.get("rt", ""))
+                if error is not None:
+                    self.send_json({"error": error}, 400)
+                    return
+                headers["X-Next-Token"] = rt
+
+        if options.error_rate and random.random() < options.error_rate:
+            self.send_json({"error": "try_again"}, 503, headers)
+            return
+
+        body = self.route(method, path, params, headers)
+        self.send_json(body, 400 if "error" in body else 200, headers)
+
+    def route(self, method: str, path: str, params: dict, headers: dict) -> dict:
+        fake = self.server.fake
+        base_url = self.server.base_url
+
+        if path == "/token":
+            token, rt = fake.issue_token(None)
+            headers["X-Next-Token"] = rt
+            return {"accessToken": token}
+
+        if path == "/authorize":
+            uid = str(params.get("uid", "")).lower()
+            if not uid or not params.get("pass"):
+                return {"error": "invalid_user_credentials"}
+            token, rt = fake.issue_token(uid)
+            headers["X-Next-Token"] = rt
+            return {"accessToken": token, "user": fake.profile(uid, base_url)}
+
+        if path == "/my/profile":
+            session = fake.tokens.get(self.headers.get("X-Access-Token", ""), {})
+            if not session.get("uid"):
+                return {"error": "session_invalid"}
+            return {"profile": fake.profile(session["uid"], base_url)}
+
+        if path == "/users/details":
+            return {"user": fake.profile(params["uid"].lower(), base_url)}
+
+        if path == "/users/profile/stream":
+            items = fake.timeline(params["uid"].lower(), base_url)
+            limit = int(params.get("limit", 50))
+            if "from" in params:
+                from_ts = int(params["from"])
+                items = [item for item in items if item["ts"] < from_ts]
+            else:
+                items = items[int(params.get("offset", 0)) :]
+            return {"items": items[:limit], "hasMore": True}
+
+        if path == "/answers/chats":
+            data = fake.find(int(params["qid"]))
+            if data is None or not data["chat"]:
+                return {"error": "data_not_found"}
+            chat = fake.chat(data)
+            # pages go backwards from the newest message, `from` is exclusive
+            messages = chat["messages"]
+            if "from" in params:
+                messages = [m for m in messages if m["createdAt"] < int(params["from"])]
+            limit = int(params.get("limit", 100))
+            chat["messages"] = messages[-limit:]
+            chat["hasOlder"] = len(messages) > limit
+            return chat
+
+        return {"error": "not_allowed"}
+
+    def serve_media(self, name: str):
+        payload = self.server.fake.media(name)
+        size = len(payload)
+        start = 0
+        # only the `bytes=<start>-` ranges that resumed downloads ask for
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        self.wfile.write(payload[start:])
+
+
+class FakeAskfmServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], options: FakeOptions):
+        super().__init__(address, FakeAskfmHandler)
+        self.fake = FakeAskfm(options)
+        self._thread: threading.Thread | None = None
+
+    @property
+    def host(self) -> str:
+        """The value to pass as `host` to AskfmApi (with scheme="http")."""
+        host, port = self.server_address[:2]
+        return f"{host}:{port}"
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}"
+
+    def start(self) -> "FakeAskfmServer":
+        """Serve on a background thread, e.g. from a benchmark script."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="askfm-fake-server",
+        description="serves a synthetic ask.fm API for offline load testing",
+    )
+    parser.add_argument("--bind", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--api-key", default=FakeOptions.api_key)
+    parser.add_argument("--seed", type=int, default=FakeOptions.seed)
+    parser.add_argument("--answers", type=int, default=FakeOptions.answers)
+    parser.add_argument("--chat-ratio", type=float, default=FakeOptions.chat_ratio)
+    parser.add_argument("--photo-ratio", type=float, default=FakeOptions.photo_ratio)
+    parser.add_argument("--latency", type=float, default=FakeOptions.latency)
+    parser.add_argument("--jitter", type=float, default=FakeOptions.jitter)
+    parser.add_argument("--error-rate", type=float, default=FakeOptions.error_rate)
+    parser.add_argument("--session-ttl", type=float, default=FakeOptions.session_ttl)
+    parser.add_argument("--rate", type=float, default=FakeOptions.rate)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    options = FakeOptions(
+        api_key=args.api_key,
+        seed=args.seed,
+        answers=args.answers,
+        chat_ratio=args.chat_ratio,
+        photo_ratio=args.photo_ratio,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        session_ttl=args.session_ttl,
+        rate=args.rate,
+    )
+    server = FakeAskfmServer((args.bind, args.port), options)
+    print(f"serving a fake ask.fm API on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable
+
+import config
+from database import Database, WatchScheduleModel
+
+HOUR = 3600
+
+
+def check_interval(
+    answer_times: list[int], now: int, min_interval: int, max_interval: int
+) -> int:
+    """
+    Seconds until a profile should be checked again, from the created_at of its
+    newest answers (newest first): about the time it usually takes the profile to
+    post an answer, and longer the longer it has been quiet.
+    """
+    if len(answer_times) == 0:
+        return max_interval
+
+    usual = max_interval
+    if len(answer_times) > 1:
+        usual = (answer_times[0] - answer_times[-1]) / (len(answer_times) - 1)
+    quiet = now - answer_times[0]
+    interval = max(usual, quiet / 2)
+    return int(min(max(interval, min_interval), max_interval))
+
+
+class Watcher:
+    """
+    Archives a fixed set of profiles over and over, in a single long-running
+    process so that the API session stays warm.
+
+    Every profile has its own next check, scheduled from how often it has been
+    answering lately. The schedule is kept in the database (`watch_schedule`)
+    so a restarted watcher continues where the previous one stopped. Checks are
+    postponed while the requests made during the last hour exceed @budget.
+    """
+
+    def __init__(
+        self,
+        usernames: list[str],
+        archive: Callable[[str], dict],
+        requests_made: Callable[[], int],
+        budget: int = config.watch_request_budget,
+        min_interval: int = config.watch_min_interval,
+        max_interval: int = config.watch_max_interval,
+    ):
+        """
+        @archive archives a profile and returns its ProfileResult
+        @requests_made total number of requests made by the process so far
+        """
+        self.logger = logging.getLogger(__name__)
+        self.usernames = [username.lower() for username in usernames]
+        self.archive = archive
+        self.requests_made = requests_made
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.db = Database(config.db_file)
+
+        # (time, requests) of the checks made during the last hour
+        self._spent: deque[tuple[float, int]] = deque()
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def _load_schedule(self) -> dict[str, WatchScheduleModel]:
+        self.db.connect()
+        stored = self.db.get_watch_schedule()
+        self.db.close()
+
+        now = int(time.time())
+        schedule = {}
+        for username in self.usernames:
+            schedule[username] = stored.get(username) or WatchScheduleModel(
+                uid=username,
+                next_check_at=now,
+                last_check_at=None,
+                interval=self.min_interval,
+            )
+        return schedule
+
+    def _spent_last_hour(self, now: float) -> int:
+        while self._spent and self._spent[0][0] <= now - HOUR:
+            self._spent.popleft()
+        return sum(requests for _, requests in self._spent)
+
+    def _reschedule(self, entry: WatchScheduleModel, ok: bool):
+        now = int(time.time())
+        self.db.connect()
+        if ok:
+            times = self.db.get_recent_answer_times(uid=entry["uid"])
+            interval = check_interval(times, now, self.min_interval, self.max_interval)
+        else:
+            # try again soon, the next failure will be just as cheap
+            interval = self.min_interval
+        entry["interval"] = interval
+        entry["last_check_at"] = now
+        entry["next_check_at"] = now + interval
+        self.db.save_watch_schedule(entry)
+        self.db.close()
+
+        next_check = datetime.fromtimestamp(entry["next_check_at"])
+        self.logger.info(f"next check of {entry['uid']} at {next_check:%Y-%m-%d %H:%M}")
+
+    def run(self):
+        """Checks the profiles as they become due, until `stop` is called."""
+        schedule = self._load_schedule()
+        if len(schedule) == 0:
+            return
+
+        while not self._stop.is_set():
+            username = min(schedule, key=lambda u: schedule[u]["next_check_at"])
+            now = time.time()
+            due = schedule[username]["next_check_at"]
+            if due > now:
+                self._stop.wait(due - now)
+                continue
+
+            spent = self._spent_last_hour(now)
+            if spent >= self.budget:
+                wait = self._spent[0][0] + HOUR - now
+                self.logger.info(
+                    f"{spent} requests made during the last hour, waiting {wait:.0f}s"
+                )
+                self._stop.wait(wait)
+                continue
+
+            before = self.requests_made()
+            try:
+                ok = self.archive(username)["ok"]
+            except Exception as e:
+                # a failing profile must not stop the checks of the others
+                self.logger.exception(f"error while checking {username}: {e}")
+                ok = False
+            self._spent.append((time.time(), self.requests_made() - before))
+            self._reschedule(schedule[username], ok)